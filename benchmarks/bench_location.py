@@ -0,0 +1,70 @@
+"""replace_location_with_abbrev 的 micro-benchmark：新的 trie 版本 vs. 原本逐棟 regex 的版本
+
+python benchmarks/bench_location.py [--number 2000]
+"""
+
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from campus import load_campus, match_locations, replace_location_with_abbrev  # noqa: E402
+
+SAMPLES = [
+    "工程三館 B1 國際會議廳",
+    "綜一B1 演講廳",
+    "學生活動中心二樓",
+    "浩然圖書資訊中心 國際會議廳",
+    "台積館 1F",
+    "Online",
+]
+
+
+def legacy_replace_location_with_abbrev(input_text):
+    for campus, buildings in load_campus().items():
+        for building_code, building_info in buildings.items():
+            tw_abbrev = building_info.get("tw-abbrev")
+            tw_name = building_info.get("tw")
+
+            if tw_abbrev and tw_abbrev in input_text:
+                input_text = input_text.replace(tw_abbrev, building_code)
+
+            if tw_name and input_text.startswith(tw_name):
+                input_text = input_text.replace(tw_name, building_code)
+
+            if tw_name and re.search(f"{tw_name}.*", input_text):
+                input_text = re.sub(f"{tw_name}", building_code, input_text)
+
+            input_text = re.sub(r"[\u4e00-\u9fff]+", lambda match: building_code, input_text)
+
+    return input_text
+
+
+def bench(fn, number):
+    seconds = min(timeit.repeat(lambda: [fn(text) for text in SAMPLES], number=number, repeat=5))
+    return seconds / (number * len(SAMPLES)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    for text in SAMPLES:
+        print(
+            f"{text!r}: legacy={legacy_replace_location_with_abbrev(text)!r} new={replace_location_with_abbrev(text)!r}"
+        )
+        for start, end, building_code, english in match_locations(text):
+            print(f"    {text[start:end]} -> {building_code} ({english})")
+
+    legacy = bench(legacy_replace_location_with_abbrev, args.number)
+    new = bench(replace_location_with_abbrev, args.number)
+    print(f"legacy: {legacy:.2f} us/call")
+    print(f"trie:   {new:.2f} us/call ({legacy / new:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""不需要任何金鑰的離線 benchmark：用簽好章的 webhook 打 handle_callback，
+LINE、Gemini、Vertex、Firebase、Whisper 都換成 fakes.py 裡可調延遲的替身
+
+    python benchmarks/bench_pipeline.py [--iterations 5] [--gemini-latency 0.8] [--output bench_results.json]
+
+量測項目：
+- text / image / audio 三條流程的 webhook 回應時間、各 handler 執行時間、
+  從送出 webhook 到使用者收到最後一則訊息的端到端時間
+- replace_location_with_abbrev 每秒可處理幾次
+- 本機有 Whisper 模型時，用產生的合成音訊量 real-time factor（沒有就略過）
+結果寫成 JSON，可以拿不同版本的結果互相比較
+"""
+
+import argparse
+import functools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fakes  # noqa: E402
+
+SAMPLE_RATE = 16000
+
+
+def summarize(samples):
+    """count / mean / p50 / p95 / p99 / max，單位和輸入相同"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": ordered[-1],
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def latency_from_args(args):
+    return fakes.Latency(
+        line=args.line_latency,
+        line_blob=args.line_blob_latency,
+        gemini=args.gemini_latency,
+        vertex=args.vertex_latency,
+        firebase=args.firebase_latency,
+        whisper_rtf=args.fake_whisper_rtf,
+    )
+
+
+def add_latency_arguments(parser):
+    parser.add_argument("--line-latency", type=float, default=0.05)
+    parser.add_argument("--line-blob-latency", type=float, default=0.1)
+    parser.add_argument("--gemini-latency", type=float, default=0.8)
+    parser.add_argument("--vertex-latency", type=float, default=0.4)
+    parser.add_argument("--firebase-latency", type=float, default=0.03)
+    parser.add_argument("--fake-whisper-rtf", type=float, default=0.3)
+    parser.add_argument("--audio-seconds", type=float, default=60, help="假錄音檔的長度")
+
+
+def setup_app(args):
+    """裝好替身後才 import main，回傳 main 模組；每個 handler 的執行時間記在 handler_seconds"""
+    fakes.install(latency_from_args(args), audio_seconds=args.audio_seconds)
+    import main
+
+    fakes.patch_line_client()
+
+    main.handler_seconds = {}
+    for key, func in list(main.handler._handlers.items()):
+        main.handler._handlers[key] = _timed_handler(key, func, main.handler_seconds)
+    return main
+
+
+def _timed_handler(key, func, results):
+    @functools.wraps(func)
+    def wrapper(*args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            results.setdefault(key, []).append(time.perf_counter() - start)
+
+    return wrapper
+
+
+def scenario_events(name, user_id, audio_seconds):
+    """每個流程要送的訊息，以及流程結束時使用者總共會收到幾則訊息"""
+    if name == "text":
+        return [fakes.text_message("\\slogan"), fakes.text_message("資工系學會 明天晚上 台積館 期末聚 吃披薩 0")], 2
+    if name == "image":
+        return [fakes.text_message("\\pdfnote"), fakes.image_message(fakes.sample_image()), fakes.text_message("n")], 4
+    if name == "audio":
+        # 內容不會被解碼（Whisper 是替身），只是讓 blob 的大小接近真的 m4a
+        audio = os.urandom(int(audio_seconds * 16000))
+        messages = [
+            fakes.text_message("\\audnote"),
+            fakes.audio_message(audio, int(audio_seconds * 1000)),
+            fakes.text_message("n"),
+        ]
+        return messages, 4
+    raise ValueError(name)
+
+
+def run_scenario(client, name, args):
+    user_id = f"U{uuid.uuid4().hex}"
+    messages, expected = scenario_events(name, user_id, args.audio_seconds)
+
+    start = time.perf_counter()
+    ack_seconds = []
+    for message in messages:
+        body = fakes.webhook_body([fakes.message_event(user_id, message)])
+        sent = time.perf_counter()
+        response = client.post(
+            "/webhooks/line",
+            content=body.encode(),
+            headers={"X-Line-Signature": fakes.sign(body), "Content-Type": "application/json"},
+        )
+        ack_seconds.append(time.perf_counter() - sent)
+        response.raise_for_status()
+
+    finished = fakes.messaging_api.wait_for(user_id, expected, args.timeout)
+    if finished is None:
+        return ack_seconds, None, "timeout"
+    # 背景工作失敗時也會推一則錯誤訊息給使用者，這種不算進延遲
+    last_texts = fakes.messaging_api.sent[user_id][expected - 1][2]
+    if any("錯誤" in text or "太多" in text for text in last_texts):
+        return ack_seconds, None, "error"
+    return ack_seconds, finished - start, None
+
+
+def bench_pipelines(args):
+    from fastapi.testclient import TestClient
+
+    main = setup_app(args)
+    results = {}
+    with TestClient(main.app) as client:
+        for name in args.scenarios:
+            ack, end_to_end, failures = [], [], {"timeout": 0, "error": 0}
+            main.handler_seconds.clear()
+            for _ in range(args.iterations):
+                ack_seconds, seconds, failure = run_scenario(client, name, args)
+                ack.extend(ack_seconds)
+                if failure is None:
+                    end_to_end.append(seconds)
+                else:
+                    failures[failure] += 1
+            results[name] = {
+                "webhook_ack_seconds": summarize(ack),
+                "end_to_end_seconds": summarize(end_to_end),
+                "handler_seconds": {key: summarize(values) for key, values in main.handler_seconds.items()},
+                "failures": failures,
+            }
+            print(f"{name}: end-to-end p50={results[name]['end_to_end_seconds'].get('p50', float('nan')):.3f}s")
+    return results
+
+
+def bench_location(number):
+    from bench_location import SAMPLES
+    from campus import replace_location_with_abbrev
+
+    seconds = min(
+        timeit.repeat(lambda: [replace_location_with_abbrev(text) for text in SAMPLES], number=number, repeat=5)
+    )
+    calls = number * len(SAMPLES)
+    result = {"calls_per_second": calls / seconds, "us_per_call": seconds / calls * 1e6}
+    print(f"replace_location_with_abbrev: {result['calls_per_second']:.0f} calls/s")
+    return result
+
+
+def synthetic_speech(seconds, seed=0):
+    """像語音的合成訊號：基頻會飄動的諧波、每秒約 4 個音節的振幅起伏、每幾秒一段停頓，再加一點雜訊"""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    f0 = 140 + 30 * np.sin(2 * np.pi * 0.3 * t) + 10 * np.sin(2 * np.pi * 2.1 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 8))
+    syllables = np.clip(np.sin(2 * np.pi * 4 * t), 0, None)
+    pauses = (np.sin(2 * np.pi * t / 5) > -0.8).astype(np.float32)
+    audio = 0.3 * voiced * syllables * pauses + 0.01 * rng.standard_normal(len(t))
+    return audio.astype(np.float32)
+
+
+def bench_whisper(seconds):
+    """本機已經有 Whisper 模型時才量，不會從網路下載；要在 fakes.install 換掉模組之前呼叫"""
+    try:
+        import whisperx_audio2text
+        from faster_whisper import WhisperModel
+    except ImportError as e:
+        return {"skipped": f"faster-whisper is not installed ({e})"}
+
+    key = (whisperx_audio2text.model_size, whisperx_audio2text.device, whisperx_audio2text.compute_type)
+    try:
+        load_start = time.perf_counter()
+        whisperx_audio2text._models[key] = WhisperModel(key[0], key[1], compute_type=key[2], local_files_only=True)
+        load_seconds = time.perf_counter() - load_start
+    except Exception as e:
+        return {"skipped": f"no local {key[0]} model ({e})"}
+
+    audio = synthetic_speech(seconds)
+    start = time.perf_counter()
+    language, segments = whisperx_audio2text.stream_transcribe(audio)
+    segments = list(segments)
+    elapsed = time.perf_counter() - start
+    result = {
+        "model": key[0],
+        "device": key[1],
+        "compute_type": key[2],
+        "audio_seconds": seconds,
+        "load_seconds": load_seconds,
+        "processing_seconds": elapsed,
+        "rtf": elapsed / seconds,
+        "segments": len(segments),
+    }
+    print(f"whisper {key[0]}: RTF {result['rtf']:.3f}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument(
+        "--scenarios", nargs="+", default=["text", "image", "audio"], choices=["text", "image", "audio"]
+    )
+    parser.add_argument("--timeout", type=float, default=120, help="等一個流程結束最多幾秒")
+    parser.add_argument("--location-number", type=int, default=2000)
+    parser.add_argument("--whisper-seconds", type=float, default=30, help="合成音訊長度，0 代表不量 Whisper")
+    parser.add_argument("--output", default="bench_results.json")
+    add_latency_arguments(parser)
+    args = parser.parse_args()
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {**vars(args), "latency": latency_from_args(args).to_dict()},
+        "location": bench_location(args.location_number),
+        # Whisper 要在替身裝上去之前量
+        "whisper": bench_whisper(args.whisper_seconds) if args.whisper_seconds > 0 else {"skipped": "disabled"},
+        "pipelines": bench_pipelines(args),
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
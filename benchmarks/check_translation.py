@@ -0,0 +1,43 @@
+"""翻譯流程的離線檢查：模型沒有照編號回答、中間又夾著翻譯記憶命中的句子時，
+每句的翻譯還是要留在原本的位置
+
+    python benchmarks/check_translation.py
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakes  # noqa: E402
+
+
+class UnnumberedModel:
+    """不照編號回答的模型：把收到的原文整段包成一行"""
+
+    def generate_content(self, contents, **kwargs):
+        lines = fakes._prompt_text(contents).splitlines()[1:]
+        return fakes.FakeResponse(f"T({' '.join(lines)})")
+
+
+def check_memo_hit_inside_failed_batch(translation):
+    translation._memo_put("Beta.", "乙")
+    result = translation.main("Alpha. Beta. Gamma.", "en")
+    expected = "T(Alpha.)\n乙\nT(Gamma.)"
+    assert result == expected, f"{result!r} != {expected!r}"
+
+
+def main():
+    fakes.install()
+    import translation
+
+    with tempfile.TemporaryDirectory() as tmp:
+        translation.translation_memo_path = os.path.join(tmp, "memo.sqlite3")
+        translation.get_model = lambda *args, **kwargs: UnnumberedModel()
+        check_memo_hit_inside_failed_batch(translation)
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
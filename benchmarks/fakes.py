@@ -0,0 +1,391 @@
+"""benchmark 用的本機替身：LINE messaging/blob API、google.generativeai、Vertex AI、
+firebase.FirebaseApplication 和 Whisper，每個都可以設定延遲，不需要任何金鑰或網路
+
+    import fakes
+    fakes.install(fakes.Latency(gemini=0.8))   # 要在 import main 之前
+    import main
+    fakes.patch_line_client()                  # import main 之後
+"""
+
+import asyncio
+import base64
+import copy
+import hashlib
+import hmac
+import io
+import json
+import mimetypes
+import re
+import sys
+import threading
+import time
+import types
+import uuid
+
+CHANNEL_SECRET = "bench-channel-secret"
+CHANNEL_ACCESS_TOKEN = "bench-channel-access-token"
+
+
+class Latency:
+    """每個替身每次呼叫要睡多久（秒）；whisper_rtf 是轉錄時間 / 音檔長度"""
+
+    def __init__(self, line=0.05, line_blob=0.1, gemini=0.8, vertex=0.4, firebase=0.03, whisper_rtf=0.3):
+        self.line = line
+        self.line_blob = line_blob
+        self.gemini = gemini
+        self.vertex = vertex
+        self.firebase = firebase
+        self.whisper_rtf = whisper_rtf
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+latency = Latency()
+
+
+# ---- firebase ----
+
+
+class FakeFirebaseApplication:
+    """python-firebase 的 get/put/patch/delete/put_async，資料放在所有 instance 共用的 dict"""
+
+    _data = {}
+    _lock = threading.Lock()
+
+    def __init__(self, dsn, authentication=None):
+        self.dsn = dsn
+
+    @staticmethod
+    def _path(url, name):
+        return "/".join(part.strip("/") for part in (url, name) if part)
+
+    def get(self, url, name, **kwargs):
+        time.sleep(latency.firebase)
+        with self._lock:
+            return copy.deepcopy(self._data.get(self._path(url, name)))
+
+    def put(self, url, name, data, **kwargs):
+        time.sleep(latency.firebase)
+        with self._lock:
+            self._data[self._path(url, name)] = copy.deepcopy(data)
+        return data
+
+    def patch(self, url, data, **kwargs):
+        # 跟 Firebase 一樣只改給定的欄位，值是 None 的欄位刪掉
+        time.sleep(latency.firebase)
+        path = self._path(url, None)
+        with self._lock:
+            node = {**(self._data.get(path) or {}), **copy.deepcopy(data)}
+            node = {key: value for key, value in node.items() if value is not None}
+            if node:
+                self._data[path] = node
+            else:
+                self._data.pop(path, None)
+        return data
+
+    def put_async(self, url, name, data, callback=None, **kwargs):
+        threading.Thread(target=self.put, args=(url, name, data), daemon=True).start()
+
+    def delete(self, url, name, **kwargs):
+        time.sleep(latency.firebase)
+        path = self._path(url, name)
+        with self._lock:
+            for key in [key for key in self._data if key == path or key.startswith(path + "/")]:
+                del self._data[key]
+
+
+# ---- google.generativeai ----
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.candidates = [types.SimpleNamespace(text=text)]
+        self.usage_metadata = None
+
+
+def _prompt_text(contents):
+    if isinstance(contents, str):
+        return contents
+    return "\n".join(part for part in contents if isinstance(part, str))
+
+
+def _gemini_answer(prompt):
+    # 依照 prompt 回傳格式正確的假資料，讓後面的 json.loads 等步驟照常執行
+    if "Google Calendar" in prompt:
+        return json.dumps(
+            {
+                "time": "20240409T070000Z/20240409T080000Z",
+                "location": "台積館",
+                "title": "benchmark",
+                "content": "- 注意事項",
+            },
+            ensure_ascii=False,
+        )
+    if '"documentTitle"' in prompt:
+        return json.dumps({"info": {"title": "benchmark", "documentTitle": "benchmark"}})
+    if '"requests"' in prompt:
+        return json.dumps({"requests": []})
+    return "# 重點筆記\n" + "\n".join(f"- 第 {i + 1} 點" for i in range(10))
+
+
+class FakeGenerativeModel:
+    def __init__(self, model_name, **kwargs):
+        self.model_name = model_name
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(latency.gemini)
+        return FakeResponse(_gemini_answer(_prompt_text(contents)))
+
+    async def generate_content_async(self, contents, **kwargs):
+        await asyncio.sleep(latency.gemini)
+        return FakeResponse(_gemini_answer(_prompt_text(contents)))
+
+
+def _upload_file(path=None, mime_type=None, **kwargs):
+    # 跟真的 SDK 一樣，沒給 mime_type 又猜不出來就失敗
+    if mime_type is None and mimetypes.guess_type(path)[0] is None:
+        raise ValueError(f"Unknown mime type: Could not determine the mimetype for your file\n    {path}")
+    time.sleep(latency.gemini)
+    return types.SimpleNamespace(name=f"files/{uuid.uuid4().hex}")
+
+
+def _delete_file(name):
+    time.sleep(latency.gemini / 4)
+
+
+def _make_genai():
+    genai = types.SimpleNamespace()
+    genai.configure = lambda **kwargs: None
+    genai.GenerativeModel = FakeGenerativeModel
+    genai.upload_file = _upload_file
+    genai.delete_file = _delete_file
+    return genai
+
+
+# ---- Vertex AI ----
+
+NUMBERED_LINE = re.compile(r"^\[(\d+)\]\s*(.*)$")
+
+
+class FakeVertexModel:
+    def __init__(self, model_name, **kwargs):
+        self.model_name = model_name
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(latency.vertex)
+        lines = _prompt_text(contents).splitlines()[1:]
+        numbered = [NUMBERED_LINE.match(line) for line in lines]
+        if lines and all(numbered):
+            text = "\n".join(f"[{m.group(1)}] 譯：{m.group(2)}" for m in numbered)
+        else:
+            text = "\n".join(f"譯：{line}" for line in lines)
+        return FakeResponse(text)
+
+
+def _make_vertexai():
+    vertexai = types.ModuleType("vertexai")
+    vertexai.init = lambda **kwargs: None
+    generative_models = types.ModuleType("vertexai.generative_models")
+    generative_models.GenerativeModel = FakeVertexModel
+    generative_models.Part = types.SimpleNamespace
+    generative_models.SafetySetting = types.SimpleNamespace
+    vertexai.generative_models = generative_models
+    return vertexai, generative_models
+
+
+# ---- Whisper ----
+
+SENTENCES = [
+    "Today we are going to talk about hypothesis testing.",
+    "The null hypothesis says there is no difference between the groups.",
+    "We compute the test statistic and compare it with the critical value.",
+    "If the p value is small enough we reject the null hypothesis.",
+]
+
+
+def _make_whisper(audio_seconds):
+    """取代 whisperx_audio2text：依 whisper_rtf 模擬轉錄時間，每 10 秒音檔產生一個 segment"""
+    whisper = types.ModuleType("whisperx_audio2text")
+    whisper.model_size = "fake"
+    whisper.compute_type = "fake"
+
+    def stream_transcribe(audio_file):
+        count = max(1, int(audio_seconds / 10))
+
+        def segments():
+            for i in range(count):
+                time.sleep(audio_seconds * latency.whisper_rtf / count)
+                yield {"text": SENTENCES[i % len(SENTENCES)], "start": i * 10.0, "end": (i + 1) * 10.0}
+
+        return "en", segments()
+
+    whisper.stream_transcribe = stream_transcribe
+    whisper.shutdown_chunk_pool = lambda: None
+    return whisper
+
+
+# ---- LINE messaging / blob API ----
+
+
+class FakeMessagingApi:
+    """記錄每則 reply/push 的時間，benchmark 用來判斷一個流程什麼時候結束"""
+
+    def __init__(self):
+        self.sent = {}
+        self._cond = threading.Condition()
+
+    def _record(self, user_id, kind, messages):
+        with self._cond:
+            self.sent.setdefault(user_id, []).append((time.perf_counter(), kind, [m.text for m in messages]))
+            self._cond.notify_all()
+
+    def reply_message(self, request):
+        time.sleep(latency.line)
+        # benchmark 產生的 reply token 是 "{user_id}:{n}"
+        self._record(request.reply_token.split(":", 1)[0], "reply", request.messages)
+
+    def push_message(self, request):
+        time.sleep(latency.line)
+        self._record(request.to, "push", request.messages)
+
+    def wait_for(self, user_id, count, timeout):
+        """等到這個使用者收到 count 則訊息，回傳最後一則的時間；逾時回傳 None"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: len(self.sent.get(user_id, ())) >= count, timeout):
+                return None
+            return self.sent[user_id][count - 1][0]
+
+
+class FakeBlobApi:
+    def __init__(self):
+        self.contents = {}
+
+    def register(self, data):
+        message_id = uuid.uuid4().hex[:16]
+        self.contents[message_id] = data
+        return message_id
+
+    def get_message_content(self, message_id):
+        time.sleep(latency.line_blob)
+        return self.contents.pop(message_id)
+
+
+messaging_api = FakeMessagingApi()
+blob_api = FakeBlobApi()
+
+
+def install(config=None, audio_seconds=60):
+    """換掉 firebase、vertexai、whisperx_audio2text 模組，並設定 benchmark 用的環境變數"""
+    import os
+
+    global latency
+    if config is not None:
+        latency = config
+
+    env = {
+        "API_ENV": "production",
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": CHANNEL_ACCESS_TOKEN,
+        "FIREBASE_URL": "https://bench.invalid",
+        "TOKEN_ENCRYPTION_KEY": base64.urlsafe_b64encode(b"bench" * 6 + b"!!").decode(),
+        "STARTUP_WARMUP": "",
+        # 每次都要真的跑完整個流程，不能被快取擋掉
+        "CACHE_PATH": "",
+        "TRANSLATION_MEMO_PATH": "",
+    }
+    for key, value in env.items():
+        os.environ[key] = value
+
+    firebase_package = types.ModuleType("firebase")
+    firebase_module = types.ModuleType("firebase.firebase")
+    firebase_module.FirebaseApplication = FakeFirebaseApplication
+    firebase_package.firebase = firebase_module
+    vertexai, generative_models = _make_vertexai()
+    sys.modules.update(
+        {
+            "firebase": firebase_package,
+            "firebase.firebase": firebase_module,
+            "vertexai": vertexai,
+            "vertexai.generative_models": generative_models,
+            "whisperx_audio2text": _make_whisper(audio_seconds),
+        }
+    )
+
+    import gemini
+
+    gemini.genai = _make_genai()
+    gemini.RETRYABLE = ()
+    gemini._configured = True
+
+
+def patch_line_client():
+    import line_client
+
+    line_client.messaging_api = lambda: messaging_api
+    line_client.blob_api = lambda: blob_api
+
+
+# ---- webhook payload ----
+
+
+def sign(body, secret=CHANNEL_SECRET):
+    """X-Line-Signature：channel secret 對 body 做 HMAC-SHA256 再 base64"""
+    digest = hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+_reply_counter = 0
+_reply_lock = threading.Lock()
+
+
+def message_event(user_id, message):
+    global _reply_counter
+    with _reply_lock:
+        _reply_counter += 1
+        reply_token = f"{user_id}:{_reply_counter}"
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": uuid.uuid4().hex,
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": reply_token,
+        "message": message,
+    }
+
+
+def text_message(text):
+    return {"id": uuid.uuid4().hex[:16], "type": "text", "quoteToken": uuid.uuid4().hex, "text": text}
+
+
+def image_message(data):
+    return {
+        "id": blob_api.register(data),
+        "type": "image",
+        "quoteToken": uuid.uuid4().hex,
+        "contentProvider": {"type": "line"},
+    }
+
+
+def audio_message(data, duration_ms):
+    return {
+        "id": blob_api.register(data),
+        "type": "audio",
+        "duration": duration_ms,
+        "contentProvider": {"type": "line"},
+    }
+
+
+def webhook_body(events):
+    return json.dumps({"destination": "Ubench", "events": events}, ensure_ascii=False)
+
+
+def sample_image(size=(1280, 960)):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (200, 120, 40)).save(buffer, format="JPEG")
+    return buffer.getvalue()
@@ -0,0 +1,243 @@
+"""/webhooks/line 的壓力測試：用 LINE_CHANNEL_SECRET 簽好 X-Line-Signature，
+依設定的速率和同時連線數送出混合的事件（文字指令、圖片、音檔、一次多個事件的 batch）
+
+    # 打正在跑的 app（圖片、音檔的 message id 是假的，背景處理會失敗，但 webhook 回應時間照量）
+    LINE_CHANNEL_SECRET=... python benchmarks/loadgen.py --url http://localhost:8080/webhooks/line --rate 50 --duration 30
+
+    # 離線：在同一個 process 起一個 uvicorn，外部服務全部換成 fakes.py 的替身
+    python benchmarks/loadgen.py --stub --rate 50 --duration 30 --gemini-latency 0.8
+
+延遲從「排定送出的時間」開始算，同時連線數滿了造成的排隊也會算進去
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+
+import httpx
+
+import fakes
+from bench_pipeline import add_latency_arguments, git_revision, setup_app, summarize
+
+TEXT_COMMANDS = [
+    "選項",
+    "\\slogan",
+    "資工系學會 明天晚上 台積館 期末聚 吃披薩 0",
+    "\\pdfnote",
+    "\\audnote",
+    "n",
+    "\\cancel",
+    "C",
+]
+
+
+def parse_mix(value):
+    """ "text=6,image=2" -> {"text": 6.0, "image": 2.0}"""
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in ("text", "image", "audio", "batch"):
+            raise argparse.ArgumentTypeError(f"unknown event kind {kind!r}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+class EventFactory:
+    def __init__(self, args):
+        self.stub = args.stub
+        self.users = [f"U{uuid.uuid4().hex}" for _ in range(args.users)]
+        self.kinds = list(args.mix)
+        self.weights = list(args.mix.values())
+        self.batch_size = args.batch_size
+        self.image = fakes.sample_image((640, 480))
+        self.audio = os.urandom(args.audio_bytes)
+
+    def _media(self, message):
+        # 打真的 app 時不會有人來拿內容，不用留著
+        if not self.stub:
+            fakes.blob_api.contents.pop(message["id"], None)
+        return message
+
+    def _message(self, kind):
+        if kind == "image":
+            return self._media(fakes.image_message(self.image))
+        if kind == "audio":
+            return self._media(fakes.audio_message(self.audio, 60000))
+        return fakes.text_message(random.choice(TEXT_COMMANDS))
+
+    def body(self):
+        kind = random.choices(self.kinds, self.weights)[0]
+        if kind == "batch":
+            events = [
+                fakes.message_event(random.choice(self.users), self._message(random.choice(["text", "text", "image"])))
+                for _ in range(self.batch_size)
+            ]
+        else:
+            events = [fakes.message_event(random.choice(self.users), self._message(kind))]
+        return kind, fakes.webhook_body(events), len(events)
+
+
+async def send(client, url, secret, kind, body, scheduled, results):
+    start = time.perf_counter()
+    try:
+        response = await client.post(
+            url,
+            content=body.encode(),
+            headers={"X-Line-Signature": fakes.sign(body, secret), "Content-Type": "application/json"},
+        )
+        outcome = str(response.status_code)
+    except httpx.HTTPError as e:
+        outcome = e.__class__.__name__
+    end = time.perf_counter()
+    results.append((kind, outcome, end - scheduled, end - start))
+
+
+async def run_load(args, url, secret):
+    factory = EventFactory(args)
+    results = []
+    events_sent = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async def limited(*send_args):
+        async with semaphore:
+            await send(*send_args)
+
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        tasks = []
+        started = time.perf_counter()
+        total = int(args.rate * args.duration)
+        for i in range(total):
+            scheduled = started + i / args.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind, body, count = factory.body()
+            events_sent += count
+            tasks.append(asyncio.ensure_future(limited(client, url, secret, kind, body, scheduled, results)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+        try:
+            stats = (await client.get(url.rsplit("/webhooks/line", 1)[0] + "/stats")).json()
+        except (httpx.HTTPError, ValueError):
+            stats = None
+
+    return report(args, results, events_sent, elapsed, stats)
+
+
+def report(args, results, events_sent, elapsed, stats):
+    outcomes = Counter(outcome for _, outcome, _, _ in results)
+    ok = [row for row in results if row[1].startswith("2")]
+    by_kind = {}
+    for kind in sorted({row[0] for row in results}):
+        rows = [row for row in results if row[0] == kind]
+        by_kind[kind] = {
+            "requests": len(rows),
+            "error_rate": sum(1 for row in rows if not row[1].startswith("2")) / len(rows),
+            "latency_seconds": summarize([row[2] for row in rows if row[1].startswith("2")]),
+        }
+
+    return {
+        "requests": len(results),
+        "events": events_sent,
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(results) / elapsed if elapsed else 0.0,
+        "events_per_second": events_sent / elapsed if elapsed else 0.0,
+        "error_rate": 1 - len(ok) / len(results) if results else 0.0,
+        # LINE 等太久會當成失敗重送，超過門檻的也要注意
+        "slow_rate": sum(1 for row in ok if row[2] > args.slow_threshold) / len(results) if results else 0.0,
+        "outcomes": dict(outcomes),
+        "latency_seconds": summarize([row[2] for row in ok]),
+        "service_seconds": summarize([row[3] for row in ok]),
+        "by_kind": by_kind,
+        "server_stats": stats,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stub_server(args):
+    """裝好替身後在背景 thread 起 uvicorn，回傳 (server, thread, url)"""
+    import uvicorn
+
+    main = setup_app(args)
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="loadgen-server", daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread, f"http://127.0.0.1:{port}/webhooks/line"
+
+
+def print_report(result):
+    latency = result["latency_seconds"]
+    print(f"requests: {result['requests']} ({result['events']} events) in {result['elapsed_seconds']:.1f}s")
+    print(f"throughput: {result['throughput_rps']:.1f} req/s, {result['events_per_second']:.1f} events/s")
+    print(f"errors: {result['error_rate']:.2%} {result['outcomes']}, slow: {result['slow_rate']:.2%}")
+    if latency["count"]:
+        print(
+            f"latency: p50={latency['p50'] * 1000:.1f}ms p95={latency['p95'] * 1000:.1f}ms p99={latency['p99'] * 1000:.1f}ms"
+        )
+    for kind, stat in result["by_kind"].items():
+        p95 = stat["latency_seconds"].get("p95")
+        p95 = "-" if p95 is None else f"{p95 * 1000:.1f}ms"
+        print(f"  {kind}: {stat['requests']} requests, errors {stat['error_rate']:.2%}, p95 {p95}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8080/webhooks/line")
+    parser.add_argument("--stub", action="store_true", help="在本機起一個外部服務全換成替身的 app 來打")
+    parser.add_argument("--secret", default=os.getenv("LINE_CHANNEL_SECRET"))
+    parser.add_argument("--rate", type=float, default=20, help="每秒送出幾個 webhook request")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("text=6,image=2,audio=1,batch=1"))
+    parser.add_argument("--batch-size", type=int, default=5)
+    parser.add_argument("--audio-bytes", type=int, default=64 * 1024)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--slow-threshold", type=float, default=1.0)
+    parser.add_argument("--output", help="把結果另外寫成 JSON")
+    add_latency_arguments(parser)
+    args = parser.parse_args()
+
+    server = None
+    url, secret = args.url, args.secret
+    if args.stub:
+        server, thread, url = start_stub_server(args)
+        secret = fakes.CHANNEL_SECRET
+    elif not secret:
+        parser.error("LINE_CHANNEL_SECRET or --secret is required without --stub")
+
+    try:
+        result = asyncio.run(run_load(args, url, secret))
+    finally:
+        if server is not None:
+            # 等 uvicorn 跑完 app 的 shutdown hook，LINE client 等連線才會關乾淨
+            server.should_exit = True
+            thread.join()
+
+    print_report(result)
+    if args.output:
+        config = {key: value for key, value in vars(args).items() if key != "secret"}
+        with open(args.output, "w") as f:
+            json.dump({"revision": git_revision(), "config": config, **result}, f, ensure_ascii=False, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
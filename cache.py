@@ -0,0 +1,138 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__file__)
+
+# 設成空字串就關掉快取
+cache_path = os.getenv("CACHE_PATH", ".cache/pipeline.sqlite3")
+cache_max_bytes = int(os.getenv("CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+class DiskCache:
+    """存在 SQLite 的 key-value 快取，超過 max_bytes 時把最久沒用到的刪掉（LRU）"""
+
+    def __init__(self, path, max_bytes):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, value):
+        size = len(value.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._size += size - (old[0] if old else 0)
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._size -= row[0]
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            rows = self._conn.execute("SELECT key, size FROM entries ORDER BY accessed LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._size -= size
+                if self._size <= self.max_bytes:
+                    break
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if not cache_path:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = DiskCache(cache_path, cache_max_bytes)
+        return _cache
+
+
+def content_key(*parts):
+    """把每個 stage 的輸入（內容 hash、模型、prompt 版本…）合成一個 key"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        elif part is None:
+            part = b""
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+def bytes_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get(key):
+    cache = get_cache()
+    if cache is None:
+        return None
+    try:
+        return cache.get(key)
+    except sqlite3.Error as e:
+        logger.warning(f"cache read failed: {e}")
+        return None
+
+
+def put(key, value):
+    cache = get_cache()
+    if cache is None:
+        return
+    try:
+        cache.put(key, value)
+    except sqlite3.Error as e:
+        logger.warning(f"cache write failed: {e}")
+
+
+def get_json(key):
+    value = get(key)
+    return None if value is None else json.loads(value)
+
+
+def put_json(key, value):
+    put(key, json.dumps(value, ensure_ascii=False))
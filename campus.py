@@ -0,0 +1,69 @@
+import json
+import os
+from functools import lru_cache
+
+campus_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "campus.json")
+
+
+@lru_cache(maxsize=None)
+def load_campus():
+    with open(campus_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def build_location_index(campus_data):
+    """把所有建築的 tw 和 tw-abbrev 建成一棵 trie，節點上的 None key 存 (代碼, 英文名稱)"""
+    trie = {}
+    for campus, buildings in campus_data.items():
+        for building_code, building_info in buildings.items():
+            for name in (building_info.get("tw"), building_info.get("tw-abbrev")):
+                if not name:
+                    continue
+                node = trie
+                for char in name:
+                    node = node.setdefault(char, {})
+                # 同名的建築以先出現的為準
+                node.setdefault(None, (building_code, building_info.get("English")))
+    return trie
+
+
+@lru_cache(maxsize=None)
+def location_index():
+    # 第一次用到時才讀 campus.json 建索引，之後共用
+    return build_location_index(load_campus())
+
+
+def match_locations(input_text, index=None):
+    """由左到右掃一次，每個位置取最長的建築名稱，回傳 [(start, end, 代碼, 英文名稱), ...]"""
+    if index is None:
+        index = location_index()
+    matches = []
+    i = 0
+    while i < len(input_text):
+        node = index
+        longest = None
+        j = i
+        while j < len(input_text) and input_text[j] in node:
+            node = node[input_text[j]]
+            j += 1
+            if None in node:
+                longest = (j, node[None])
+        if longest is None:
+            i += 1
+            continue
+        end, (building_code, english) = longest
+        matches.append((i, end, building_code, english))
+        i = end
+    return matches
+
+
+def replace_location_with_abbrev(input_text):
+    """把文字中的建築名稱換成建築代碼，例如「工程三館 B1」→「EC B1」"""
+    parts = []
+    last = 0
+    for start, end, building_code, english in match_locations(input_text):
+        parts.append(input_text[last:start])
+        parts.append(building_code)
+        last = end
+    parts.append(input_text[last:])
+    return "".join(parts)
@@ -0,0 +1,109 @@
+import inspect
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot.v3 import WebhookHandler
+from linebot.v3.webhooks import MessageEvent
+
+import metrics
+
+logger = logging.getLogger(__file__)
+
+dispatch_workers = int(os.getenv("DISPATCH_WORKERS", "8"))
+
+
+def _source_key(event):
+    source = getattr(event, "source", None)
+    for attr in ("user_id", "group_id", "room_id"):
+        value = getattr(source, attr, None)
+        if value:
+            return value
+    return None
+
+
+class ConcurrentWebhookHandler(WebhookHandler):
+    """驗證簽章後就把事件丟給 worker pool，webhook 可以馬上回 200。
+    同一個使用者的事件依序處理，不同使用者的事件平行處理"""
+
+    def __init__(self, channel_secret, workers=dispatch_workers):
+        super().__init__(channel_secret)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatch")
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stats = {"received": 0, "processed": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+
+    def dispatch(self, body, signature):
+        """驗證並解析 webhook，回傳收到的事件數；簽章錯誤會丟 InvalidSignatureError"""
+        payload = self.parser.parse(body, signature, as_payload=True)
+        for event in payload.events:
+            self._enqueue(_source_key(event), (event, payload.destination, time.perf_counter()))
+        return len(payload.events)
+
+    def _enqueue(self, key, item):
+        with self._lock:
+            self._stats["received"] += 1
+            queue = self._pending.get(key)
+            if queue is not None:
+                queue.append(item)
+                return
+            self._pending[key] = deque([item])
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                queue = self._pending[key]
+                if not queue:
+                    del self._pending[key]
+                    return
+                item = queue[0]
+            self._run(*item)
+            with self._lock:
+                queue.popleft()
+
+    def _find_handler(self, event):
+        func = None
+        if isinstance(event, MessageEvent):
+            func = self._handlers.get(f"{event.__class__.__name__}_{event.message.__class__.__name__}")
+        if func is None:
+            func = self._handlers.get(event.__class__.__name__)
+        return func or self._default
+
+    def _run(self, event, destination, received_at):
+        func = self._find_handler(event)
+        error = False
+        if func is None:
+            logger.info(f"No handler of {event.__class__.__name__} and no default handler")
+        else:
+            try:
+                if len(inspect.signature(func).parameters) >= 2:
+                    func(event, destination)
+                else:
+                    func(event)
+            except Exception:
+                error = True
+                logger.exception(f"Failed to handle {event.__class__.__name__}")
+
+        # 從收到 webhook 開始算，包含排隊時間
+        elapsed = time.perf_counter() - received_at
+        metrics.observe_stage("webhook.event", elapsed, error)
+        with self._lock:
+            self._stats["processed"] += 1
+            self._stats["errors"] += int(error)
+            self._stats["total_seconds"] += elapsed
+            self._stats["max_seconds"] = max(self._stats["max_seconds"], elapsed)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["queue_depth"] = sum(len(queue) for queue in self._pending.values())
+            stats["active_users"] = len(self._pending)
+        stats["avg_seconds"] = stats["total_seconds"] / stats["processed"] if stats["processed"] else 0.0
+        return stats
+
+    def close(self, wait=False):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,65 @@
+import datetime
+import logging
+import os
+import threading
+
+import metrics
+
+logger = logging.getLogger(__file__)
+
+token_uri = "https://oauth2.googleapis.com/token"
+FORMS_SCOPES = ["https://www.googleapis.com/auth/forms.body", "https://www.googleapis.com/auth/drive"]
+# 權杖剩不到這麼多秒才會 refresh
+forms_refresh_margin = float(os.getenv("FORMS_REFRESH_MARGIN", "300"))
+
+_services = {}
+_lock = threading.Lock()
+
+
+def _needs_refresh(creds):
+    if creds.expiry is None:
+        return True
+    return creds.expiry - datetime.datetime.utcnow() < datetime.timedelta(seconds=forms_refresh_margin)
+
+
+def get_service(user_id, access_token, refresh_token, expiry=None):
+    """回傳這個使用者的 Forms service。同一組憑證共用同一個 service，
+    discovery 文件用套件內建的版本，不用每次上網抓；權杖快過期時才 refresh"""
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build
+
+    with _lock:
+        entry = _services.get(user_id)
+        if entry is None or entry["refresh_token"] != refresh_token:
+            creds = Credentials(
+                token=access_token,
+                refresh_token=refresh_token,
+                token_uri=token_uri,
+                client_id=os.getenv("CLIENT_ID"),
+                client_secret=os.getenv("CLIENT_SECRET"),
+                scopes=FORMS_SCOPES,
+                expiry=expiry,
+            )
+            service = build("forms", "v1", credentials=creds, static_discovery=True, cache_discovery=False)
+            entry = {"refresh_token": refresh_token, "creds": creds, "service": service, "lock": threading.Lock()}
+            _services[user_id] = entry
+
+    with entry["lock"]:
+        creds = entry["creds"]
+        if access_token != creds.token and (expiry is None or creds.expiry is None or expiry > creds.expiry):
+            # 權杖已經在背景 refresh 過了，直接換上新的
+            creds.token = access_token
+            creds.expiry = expiry
+        if _needs_refresh(creds):
+            try:
+                with metrics.upstream("forms", "refresh_token"):
+                    creds.refresh(Request())
+            except Exception as e:
+                logger.warning(f"Failed to refresh token of {user_id}: {e}")
+    return entry["service"]
+
+
+def forget(user_id):
+    with _lock:
+        _services.pop(user_id, None)
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__file__)
+
+default_model = "gemini-1.5-flash"
+# 依照 API 配額設定：每分鐘請求數、瞬間可用的額度、同時進行的呼叫數
+gemini_rpm = float(os.getenv("GEMINI_RPM", "15"))
+gemini_burst = int(os.getenv("GEMINI_BURST", "3"))
+gemini_max_concurrency = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+gemini_max_retries = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+gemini_backoff = float(os.getenv("GEMINI_BACKOFF", "2"))
+
+# google.generativeai import 很慢，第一次用到時才載入
+genai = None
+RETRYABLE = ()
+
+
+class TokenBucket:
+    """每秒補 rate 個 token、最多存 capacity 個。
+    呼叫者先預約 token（可以預支成負數），再等到輪到自己，所以依照先來後到的順序放行"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """預約一個 token，回傳還要等幾秒"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+    async def acquire_async(self):
+        await asyncio.sleep(self.reserve())
+
+
+_bucket = TokenBucket(gemini_rpm / 60, gemini_burst)
+# sync 和 async 的呼叫共用這一個，加起來才不會超過 GEMINI_MAX_CONCURRENCY
+_semaphore = threading.BoundedSemaphore(gemini_max_concurrency)
+_models = {}
+_configured = False
+_lock = threading.Lock()
+_stats = {}
+
+
+def configure():
+    global _configured, genai, RETRYABLE
+    with _lock:
+        if not _configured:
+            import google.generativeai
+            from google.api_core import exceptions as api_exceptions
+
+            genai = google.generativeai
+            RETRYABLE = (
+                api_exceptions.ResourceExhausted,
+                api_exceptions.TooManyRequests,
+                api_exceptions.InternalServerError,
+                api_exceptions.ServiceUnavailable,
+                api_exceptions.DeadlineExceeded,
+            )
+            genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+            _configured = True
+
+
+def get_model(model_name=default_model):
+    """同一個模型只建立一次 GenerativeModel"""
+    configure()
+    with _lock:
+        model = _models.get(model_name)
+        if model is None:
+            model = _models[model_name] = genai.GenerativeModel(model_name)
+        return model
+
+
+def _record(model_name, seconds=0.0, response=None, error=None, retried=False):
+    with _lock:
+        stat = _stats.setdefault(
+            model_name,
+            {"calls": 0, "errors": 0, "retries": 0, "total_seconds": 0.0, "prompt_tokens": 0, "output_tokens": 0},
+        )
+        stat["retries"] += int(retried)
+        if error is not None:
+            stat["errors"] += 1
+            return
+        stat["calls"] += 1
+        stat["total_seconds"] += seconds
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            stat["prompt_tokens"] += usage.prompt_token_count
+            stat["output_tokens"] += usage.candidates_token_count
+
+
+def stats():
+    """每個模型的呼叫數、錯誤、重試、平均延遲和 token 用量"""
+    with _lock:
+        return {
+            name: {**stat, "avg_seconds": stat["total_seconds"] / stat["calls"] if stat["calls"] else 0.0}
+            for name, stat in _stats.items()
+        }
+
+
+def _backoff(attempt):
+    return random.uniform(0, gemini_backoff * 2**attempt)
+
+
+def generate_content(contents, model_name=default_model, **kwargs):
+    """所有 Gemini 呼叫都走這裡：先排隊拿 rate limit 的 token，限制同時呼叫數，
+    遇到 ResourceExhausted / 5xx 會退避重試"""
+    model = get_model(model_name)
+    for attempt in range(gemini_max_retries + 1):
+        _bucket.acquire()
+        with _semaphore:
+            start = time.perf_counter()
+            try:
+                with metrics.upstream("gemini", model_name):
+                    response = model.generate_content(contents, **kwargs)
+            except RETRYABLE as e:
+                _record(model_name, error=e, retried=attempt < gemini_max_retries)
+                if attempt >= gemini_max_retries:
+                    raise
+                delay = _backoff(attempt)
+                logger.warning(f"{model_name} failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+            except Exception as e:
+                _record(model_name, error=e)
+                raise
+            else:
+                elapsed = time.perf_counter() - start
+                _record(model_name, elapsed, response)
+                logger.info(f"{model_name} answered in {elapsed:.2f}s")
+                return response
+        time.sleep(delay)
+
+
+async def _acquire_semaphore_async():
+    """在 thread 裡等 _semaphore，不卡住 event loop；等的途中被取消的話，拿到之後馬上還回去"""
+    if _semaphore.acquire(blocking=False):
+        return
+    acquiring = asyncio.ensure_future(asyncio.to_thread(_semaphore.acquire))
+    try:
+        await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        acquiring.add_done_callback(lambda future: future.cancelled() or future.exception() or _semaphore.release())
+        raise
+
+
+async def generate_content_async(contents, model_name=default_model, **kwargs):
+    """generate_content 的 async 版本，等待時不會卡住 event loop"""
+    model = get_model(model_name)
+    for attempt in range(gemini_max_retries + 1):
+        await _bucket.acquire_async()
+        await _acquire_semaphore_async()
+        try:
+            start = time.perf_counter()
+            try:
+                with metrics.upstream("gemini", model_name):
+                    response = await model.generate_content_async(contents, **kwargs)
+            except RETRYABLE as e:
+                _record(model_name, error=e, retried=attempt < gemini_max_retries)
+                if attempt >= gemini_max_retries:
+                    raise
+                delay = _backoff(attempt)
+                logger.warning(f"{model_name} failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+            except Exception as e:
+                _record(model_name, error=e)
+                raise
+            else:
+                elapsed = time.perf_counter() - start
+                _record(model_name, elapsed, response)
+                logger.info(f"{model_name} answered in {elapsed:.2f}s")
+                return response
+        finally:
+            _semaphore.release()
+        await asyncio.sleep(delay)
+
+
+def upload_file(path, **kwargs):
+    """上傳檔案也算在同一份配額裡：一樣要先拿 token、佔一個同時呼叫的名額"""
+    configure()
+    _bucket.acquire()
+    with _semaphore:
+        start = time.perf_counter()
+        try:
+            with metrics.upstream("gemini", "upload_file"):
+                uploaded = genai.upload_file(path=path, **kwargs)
+        except Exception as e:
+            _record("upload_file", error=e)
+            raise
+        _record("upload_file", time.perf_counter() - start)
+        return uploaded
+
+
+def delete_file(name):
+    configure()
+    with metrics.upstream("gemini", "delete_file"):
+        return genai.delete_file(name)
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger(__file__)
+
+connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+read_timeout = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+max_retries = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+backoff_base = float(os.getenv("HTTP_BACKOFF", "0.5"))
+backoff_max = float(os.getenv("HTTP_BACKOFF_MAX", "10"))
+pool_size = int(os.getenv("HTTP_POOL_SIZE", "10"))
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# 同一個 session 共用連線，每個 host 各自一個 connection pool
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size)
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+_async_client = None
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record(endpoint, seconds, error):
+    with _stats_lock:
+        stat = _stats.setdefault(endpoint, {"count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+        stat["count"] += 1
+        stat["errors"] += int(error)
+        stat["total_seconds"] += seconds
+        stat["max_seconds"] = max(stat["max_seconds"], seconds)
+    # endpoint 的第一段當作 upstream，例如 reurl.shorten -> reurl
+    metrics.observe_upstream(endpoint.split(".", 1)[0], endpoint, seconds, error)
+
+
+def stats():
+    """每個 endpoint 的呼叫次數、錯誤數和延遲"""
+    with _stats_lock:
+        return {
+            endpoint: {**stat, "avg_seconds": stat["total_seconds"] / stat["count"] if stat["count"] else 0.0}
+            for endpoint, stat in _stats.items()
+        }
+
+
+def _backoff(attempt):
+    # full jitter，避免大家同時重試
+    return random.uniform(0, min(backoff_max, backoff_base * 2**attempt))
+
+
+def _retry_after(response):
+    try:
+        return min(backoff_max, float(response.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+def request(method, url, endpoint=None, retries=None, timeout=None, **kwargs):
+    """所有對外的 HTTP 呼叫都走這裡：有 timeout，429/5xx 和連線錯誤會退避重試"""
+    endpoint = endpoint or urlsplit(url).netloc
+    retries = max_retries if retries is None else retries
+    timeout = timeout or (connect_timeout, read_timeout)
+
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            response = _session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            _record(endpoint, time.perf_counter() - start, error=True)
+            if attempt >= retries:
+                raise
+            delay = _backoff(attempt)
+            logger.info(f"{method} {endpoint} failed ({e}), retrying in {delay:.2f}s")
+        else:
+            failed = response.status_code in RETRY_STATUS
+            _record(endpoint, time.perf_counter() - start, error=failed)
+            if not failed or attempt >= retries:
+                return response
+            delay = _retry_after(response) or _backoff(attempt)
+            logger.info(f"{method} {endpoint} returned {response.status_code}, retrying in {delay:.2f}s")
+        time.sleep(delay)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def _get_async_client():
+    global _async_client
+    import httpx
+
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_keepalive_connections=pool_size),
+            follow_redirects=True,
+        )
+    return _async_client
+
+
+async def request_async(method, url, endpoint=None, retries=None, timeout=None, **kwargs):
+    """request 的 async 版本（httpx），重試規則相同"""
+    import httpx
+
+    endpoint = endpoint or urlsplit(url).netloc
+    retries = max_retries if retries is None else retries
+    client = _get_async_client()
+    if timeout is not None:
+        kwargs["timeout"] = timeout
+
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except (httpx.TransportError, httpx.TimeoutException) as e:
+            _record(endpoint, time.perf_counter() - start, error=True)
+            if attempt >= retries:
+                raise
+            delay = _backoff(attempt)
+            logger.info(f"{method} {endpoint} failed ({e}), retrying in {delay:.2f}s")
+        else:
+            failed = response.status_code in RETRY_STATUS
+            _record(endpoint, time.perf_counter() - start, error=failed)
+            if not failed or attempt >= retries:
+                return response
+            delay = _retry_after(response) or _backoff(attempt)
+            logger.info(f"{method} {endpoint} returned {response.status_code}, retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+
+async def get_async(url, **kwargs):
+    return await request_async("GET", url, **kwargs)
+
+
+async def aclose():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
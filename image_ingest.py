@@ -0,0 +1,39 @@
+import logging
+import os
+import time
+from io import BytesIO
+
+logger = logging.getLogger(__file__)
+
+image_max_edge = int(os.getenv("IMAGE_MAX_EDGE", "1600"))
+image_format = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+image_quality = int(os.getenv("IMAGE_QUALITY", "85"))
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+def prepare_image(data, max_edge=image_max_edge, format=image_format, quality=image_quality):
+    """把圖片縮到最長邊 max_edge、轉正、拿掉 EXIF 後重新壓縮，
+    回傳可以直接放進 Gemini contents 的 {"mime_type", "data"}"""
+    from PIL import Image, ImageOps
+
+    start = time.perf_counter()
+    image = Image.open(BytesIO(data))
+    # JPEG 可以在解碼時就直接縮小，不用先解出整張大圖
+    image.draft("RGB", (max_edge, max_edge))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_edge, max_edge), reducing_gap=3.0)
+
+    if image.mode not in ("RGB", "RGBA") or (format == "JPEG" and image.mode == "RGBA"):
+        image = image.convert("RGB")
+
+    output = BytesIO()
+    # 不帶 exif 參數存檔，metadata 就不會寫進去
+    image.save(output, format=format, quality=quality, optimize=format == "JPEG")
+    encoded = output.getvalue()
+
+    logger.info(
+        f"image {len(data) / 1024:.0f}KB -> {len(encoded) / 1024:.0f}KB {image.size[0]}x{image.size[1]} "
+        f"in {(time.perf_counter() - start) * 1000:.0f}ms"
+    )
+    return {"mime_type": MIME_TYPES[format], "data": encoded}
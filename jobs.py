@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__file__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TIMEOUT = "timeout"
+
+FINISHED = (DONE, FAILED, CANCELLED, TIMEOUT)
+
+job_workers = int(os.getenv("JOB_WORKERS", "2"))
+job_queue_size = int(os.getenv("JOB_QUEUE_SIZE", "20"))
+job_timeout = float(os.getenv("JOB_TIMEOUT", "900"))
+job_retention = float(os.getenv("JOB_RETENTION", "3600"))
+
+_executor = ThreadPoolExecutor(max_workers=job_workers, thread_name_prefix="job")
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, user_id, kind, timeout):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.kind = kind
+        self.timeout = timeout
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.on_done = None
+        self._future = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+    @property
+    def occupying(self):
+        # 逾時或取消的 job 雖然已經結束，worker thread 還在跑的話仍然佔一個名額
+        return self._future is None or not self._future.done()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "kind": self.kind,
+            "status": self.status,
+            "error": None if self.error is None else str(self.error),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+def _finish(job, status, result=None, error=None):
+    # 每個 job 只會結束一次，之後回來的結果直接丟掉
+    with job._lock:
+        if job.finished:
+            return False
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        if job._timer is not None:
+            job._timer.cancel()
+
+    if job.on_done is not None:
+        try:
+            job.on_done(job)
+        except Exception:
+            logger.exception(f"on_done callback of job {job.id} failed")
+    return True
+
+
+def _expire(job):
+    # 還在排隊的就不會執行了；已經在跑的 thread 沒辦法中斷，只能把結果丟掉
+    if job._future is not None:
+        job._future.cancel()
+    if _finish(job, TIMEOUT, error=TimeoutError(f"job exceeded {job.timeout}s")):
+        logger.warning(f"job {job.id} ({job.kind}) timed out")
+
+
+def _run(job, fn, args, kwargs):
+    with job._lock:
+        if job.finished:
+            return
+        job.status = RUNNING
+        job.started_at = time.time()
+
+    try:
+        with metrics.stage(f"job.{job.kind}"):
+            result = fn(*args, **kwargs)
+    except Exception as e:
+        logger.exception(f"job {job.id} ({job.kind}) failed")
+        _finish(job, FAILED, error=e)
+    else:
+        _finish(job, DONE, result=result)
+
+
+def _prune():
+    now = time.time()
+    for job_id, job in list(_jobs.items()):
+        if job.finished and not job.occupying and now - job.finished_at > job_retention:
+            del _jobs[job_id]
+
+
+def pending_count():
+    """排隊中加上 worker thread 還在跑的 job 數（包含已經逾時或取消、但 thread 還沒結束的）"""
+    with _jobs_lock:
+        return sum(1 for job in _jobs.values() if job.occupying)
+
+
+def submit(user_id, kind, fn, *args, on_done=None, timeout=None, **kwargs):
+    """把耗時的工作丟進背景 worker，回傳 Job；佇列滿了會丟 JobQueueFull。
+    timeout 從送出時開始算，包含排隊的時間"""
+    job = Job(user_id, kind, job_timeout if timeout is None else timeout)
+    job.on_done = on_done
+
+    with _jobs_lock:
+        _prune()
+        if sum(1 for j in _jobs.values() if j.occupying) >= job_queue_size:
+            raise JobQueueFull(f"{job_queue_size} jobs already pending")
+        _jobs[job.id] = job
+
+    job._future = _executor.submit(_run, job, fn, args, kwargs)
+    if job.timeout:
+        job._timer = threading.Timer(job.timeout, _expire, args=(job,))
+        job._timer.daemon = True
+        job._timer.start()
+    logger.info(f"job {job.id} ({kind}) submitted for {user_id}")
+    return job
+
+
+def get(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def jobs_for_user(user_id):
+    with _jobs_lock:
+        return [job for job in _jobs.values() if job.user_id == user_id]
+
+
+def cancel(job_id):
+    """取消 job；還在排隊的不會執行。執行中的 thread 沒辦法中斷，會繼續跑完，
+    只是結果被丟掉，跑完之前也仍然佔一個名額"""
+    job = get(job_id)
+    if job is None:
+        return False
+    if job._future is not None:
+        job._future.cancel()
+    return _finish(job, CANCELLED)
+
+
+def cancel_user_jobs(user_id):
+    return sum(1 for job in jobs_for_user(user_id) if not job.finished and cancel(job.id))
+
+
+def shutdown(wait=False):
+    # 還在排隊的工作標成取消，讓 on_done 有機會清掉它們用到的檔案
+    with _jobs_lock:
+        queued = [job for job in _jobs.values() if not job.finished]
+    for job in queued:
+        if job._future is not None and job._future.cancel():
+            _finish(job, CANCELLED)
+    _executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,117 @@
+import logging
+import os
+import threading
+
+from linebot.v3.messaging import (
+    ApiClient,
+    AsyncApiClient,
+    AsyncMessagingApi,
+    AsyncMessagingApiBlob,
+    MessagingApi,
+    MessagingApiBlob,
+    PushMessageRequest,
+    ReplyMessageRequest,
+    TextMessage,
+)
+
+import metrics
+
+logger = logging.getLogger(__file__)
+
+# 同時連到 api.line.me 的連線數上限
+pool_size = int(os.getenv("LINE_POOL_SIZE", "20"))
+
+_configuration = None
+_api_client = None
+_async_api_client = None
+_lock = threading.Lock()
+
+
+def init(configuration):
+    """app 啟動時呼叫一次，之後所有 LINE API 都共用同一個 connection pool"""
+    global _configuration, _api_client
+    configuration.connection_pool_maxsize = pool_size
+    with _lock:
+        _configuration = configuration
+        if _api_client is None:
+            _api_client = ApiClient(configuration)
+
+
+def _client():
+    with _lock:
+        if _api_client is None:
+            raise RuntimeError("line_client.init() has not been called")
+        return _api_client
+
+
+def messaging_api():
+    return MessagingApi(_client())
+
+
+def blob_api():
+    return MessagingApiBlob(_client())
+
+
+def reply_text(reply_token, text, quick_reply=None):
+    with metrics.upstream("line", "reply_message"):
+        messaging_api().reply_message(
+            ReplyMessageRequest(
+                reply_token=reply_token,
+                messages=[TextMessage(text=text, quick_reply=quick_reply)],
+            )
+        )
+
+
+def push_text(to, text):
+    with metrics.upstream("line", "push_message"):
+        messaging_api().push_message(PushMessageRequest(to=to, messages=[TextMessage(text=text)]))
+
+
+def get_message_content(message_id):
+    with metrics.upstream("line", "get_message_content"):
+        return blob_api().get_message_content(message_id)
+
+
+async def init_async():
+    """非同步版本要在 event loop 裡建立（底層是 aiohttp session）"""
+    global _async_api_client
+    if _async_api_client is None:
+        _async_api_client = AsyncApiClient(_configuration)
+
+
+def async_messaging_api():
+    if _async_api_client is None:
+        raise RuntimeError("line_client.init_async() has not been called")
+    return AsyncMessagingApi(_async_api_client)
+
+
+def async_blob_api():
+    if _async_api_client is None:
+        raise RuntimeError("line_client.init_async() has not been called")
+    return AsyncMessagingApiBlob(_async_api_client)
+
+
+async def reply_text_async(reply_token, text, quick_reply=None):
+    with metrics.upstream("line", "reply_message"):
+        await async_messaging_api().reply_message(
+            ReplyMessageRequest(
+                reply_token=reply_token,
+                messages=[TextMessage(text=text, quick_reply=quick_reply)],
+            )
+        )
+
+
+async def push_text_async(to, text):
+    with metrics.upstream("line", "push_message"):
+        await async_messaging_api().push_message(PushMessageRequest(to=to, messages=[TextMessage(text=text)]))
+
+
+async def close():
+    global _api_client, _async_api_client
+    with _lock:
+        client, _api_client = _api_client, None
+    if client is not None:
+        client.close()
+    if _async_api_client is not None:
+        await _async_api_client.close()
+        _async_api_client = None
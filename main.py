@@ -1,52 +1,63 @@
+import startup  # 最先 import，用來計算啟動花的時間
+
+import asyncio
+import importlib
 import json
 import logging
 import os
+import secrets
 import sys
-
-from utils import (
-    generate_promotion_data,
-    replace_location_with_abbrev,
-    speech_translate_summary,
-    make_form,
-    shorten_url_by_reurl_api,
-)
+import threading
+import time
 
 if os.getenv("API_ENV") != "production":
     from dotenv import load_dotenv
 
     load_dotenv()
 
-import tempfile
-
-import uvicorn
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import RedirectResponse
-from linebot.v3 import WebhookHandler
-from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    ApiClient,
-    Configuration,
-    MessageAction,
-    MessagingApi,
-    MessagingApiBlob,
-    QuickReply,
-    QuickReplyItem,
-    ReplyMessageRequest,
-    TextMessage,
-    PushMessageRequest,
-)
-from linebot.v3.webhooks import (
-    AccountLinkEvent,
-    AudioMessageContent,
-    ImageMessageContent,
-    MessageEvent,
-    TextMessageContent,
-)
-import requests
+# 下面的模組在 import 時就會讀環境變數，要放在 load_dotenv 之後
+# Whisper、Gemini、Vertex、Google Forms 等比較重的套件都在用到時才 import，
+# 啟動後再由 warm_up 在背景預先載入
+with startup.timed("import.fastapi"):
+    import uvicorn
+    from fastapi import FastAPI, HTTPException, Request
+    from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response
+
+with startup.timed("import.linebot"):
+    from linebot.v3.exceptions import InvalidSignatureError
+    from linebot.v3.messaging import (
+        Configuration,
+        MessageAction,
+        QuickReply,
+        QuickReplyItem,
+    )
+    from linebot.v3.webhooks import (
+        AccountLinkEvent,
+        AudioMessageContent,
+        ImageMessageContent,
+        MessageEvent,
+        TextMessageContent,
+    )
+
+with startup.timed("import.app"):
+    import forms_client
+    import gemini
+    import http_client
+    import jobs
+    import line_client
+    import metrics
+    from dispatcher import ConcurrentWebhookHandler
+    from session import BlobStore, SessionStore, blob_dir
+    from tokens import TokenStore, expiry_datetime
+    from utils import (
+        generate_promotion_data,
+        replace_location_with_abbrev,
+        speech_translate_summary,
+        make_form,
+        shorten_url_by_reurl_api,
+    )
+
 from urllib.parse import urlencode
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request as Req
-from googleapiclient.discovery import build
 
 logging.basicConfig(level=os.getenv("LOG", "WARNING"))
 logger = logging.getLogger(__file__)
@@ -61,52 +72,289 @@ if channel_secret is None:
 if channel_access_token is None:
     print("Specify LINE_CHANNEL_ACCESS_TOKEN as environment variable.")
     sys.exit(1)
+if os.getenv("TOKEN_ENCRYPTION_KEY") is None:
+    print("Specify TOKEN_ENCRYPTION_KEY as environment variable.")
+    sys.exit(1)
 
 configuration = Configuration(access_token=channel_access_token)
 
-handler = WebhookHandler(channel_secret)
+handler = ConcurrentWebhookHandler(channel_secret)
 
 
-import google.generativeai as genai
 from firebase import firebase
-from utils import check_image, create_gcal_url, is_url_valid, shorten_url_by_reurl_api
+from utils import check_image_async, create_gcal_url, is_url_valid
 
 firebase_url = os.getenv("FIREBASE_URL")
-gemini_key = os.getenv("GEMINI_API_KEY")
 client_id = os.getenv("CLIENT_ID")
 client_secret = os.getenv("CLIENT_SECRET")
 redirect_uri = os.getenv("REDIRECT_URI")
 
-# 設定 OAuth 2.0 參數
+# 設定 OAuth 2.0 參數，REDIRECT_URI 要指到這個 app 的 /oauth/callback
 scope = "https://www.googleapis.com/auth/forms.body https://www.googleapis.com/auth/drive"
-auth_url = f"https://accounts.google.com/o/oauth2/auth?{urlencode({'client_id': client_id, 'redirect_uri': redirect_uri, 'scope': scope, 'response_type': 'code', 'access_type': 'offline', 'prompt': 'consent'})}"
-
 
-CS_begin = False
-CS_audio = None
-CS_pdf = None
-form_begin = False
-authorization_code = None
-access_token = None
-refresh_token = None
+fdb = firebase.FirebaseApplication(firebase_url, None)
+sessions = SessionStore(firebase_url)
+blobs = BlobStore(blob_dir)
+token_store = TokenStore(firebase_url, client_id, client_secret, redirect_uri)
 
-# Initialize the Gemini Pro API
-genai.configure(api_key=gemini_key)
 
-
-def exchange_code_for_token(code: str):
-    """交換授權碼換取存取權杖"""
-    token_url = "https://oauth2.googleapis.com/token"
-    payload = {
-        "code": code,
+def make_auth_url(user_id, nonce):
+    # state 帶著簽過名的 user_id 和 nonce，callback 回來時才知道權杖是誰的
+    params = {
         "client_id": client_id,
-        "client_secret": client_secret,
         "redirect_uri": redirect_uri,
-        "grant_type": "authorization_code",
+        "scope": scope,
+        "response_type": "code",
+        "access_type": "offline",
+        "prompt": "consent",
+        "state": token_store.make_state(user_id, nonce),
+    }
+    return f"https://accounts.google.com/o/oauth2/auth?{urlencode(params)}"
+
+
+def warm_up_whisper():
+    from whisperx_audio2text import preload_model
+
+    preload_model()
+
+
+def warm_up_gemini():
+    gemini.get_model()
+
+
+def warm_up_forms():
+    importlib.import_module("google.oauth2.credentials")
+    importlib.import_module("googleapiclient.discovery")
+
+
+def warm_up_translation():
+    importlib.import_module("translation")
+
+
+warm_ups = {
+    "whisper": warm_up_whisper,
+    "gemini": warm_up_gemini,
+    "forms": warm_up_forms,
+    "translation": warm_up_translation,
+}
+
+
+def subsystem_names(env, default, known):
+    """逗號分隔的子系統名稱，打錯的名字記 log 後略過，不讓 app 起不來"""
+    names = [name.strip() for name in os.getenv(env, default).split(",") if name.strip()]
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        logger.warning(f"Ignoring unknown {env} entries: {', '.join(unknown)}")
+    return [name for name in names if name in known]
+
+
+# 啟動後在背景預先載入的子系統，用 STARTUP_WARMUP 設定（空字串代表都不預載）
+startup_warmup = subsystem_names("STARTUP_WARMUP", ",".join(warm_ups), warm_ups)
+# /ready 要等哪些子系統好了才回 200，例如 READY_REQUIRES=webhooks,whisper；列在這裡的一定會預載
+ready_requires = subsystem_names("READY_REQUIRES", "webhooks", ["webhooks", *warm_ups])
+startup_warmup += [name for name in ready_requires if name in warm_ups and name not in startup_warmup]
+
+
+@app.on_event("startup")
+async def open_line_client():
+    with startup.timed("startup.line_client"):
+        line_client.init(configuration)
+        await line_client.init_async()
+    token_store.start()
+    startup.mark("webhooks", startup.READY, time.perf_counter() - startup.process_started)
+
+    for name in startup_warmup:
+        startup.warm_up(name, warm_ups[name])
+    logger.info(f"startup: {startup.status()}")
+
+
+@app.on_event("shutdown")
+async def stop_jobs():
+    handler.close()
+    jobs.shutdown()
+    # 沒用過 Whisper 的話不用為了關閉而 import
+    if "whisperx_audio2text" in sys.modules:
+        sys.modules["whisperx_audio2text"].shutdown_chunk_pool()
+    sessions.close()
+    token_store.close()
+    await line_client.close()
+    await http_client.aclose()
+
+
+def deliver_job_result(job):
+    # 背景工作結束後用 push message 把結果傳給使用者
+    if job.status == jobs.DONE:
+        text = job.result
+    elif job.status == jobs.TIMEOUT:
+        text = "處理時間太長，請稍後再試一次！"
+    elif job.status == jobs.FAILED:
+        text = "處理時發生錯誤，請稍後再試一次！"
+    else:
+        return
+    line_client.push_text(job.user_id, text)
+
+
+BUSY_MESSAGE = "目前處理中的工作太多，請稍後再試一次！"
+
+
+def delete_blobs(refs):
+    for ref in refs:
+        if ref:
+            blobs.delete(ref)
+
+
+def start_job(user_id, kind, fn, *args, ack="已收到，正在處理中，完成後會傳給你！", refs=()):
+    """把工作丟到背景執行，回傳要立刻回覆給使用者的訊息；佇列滿了回傳 None，refs 的 blob 由呼叫者處理。
+    fn 自己會在 finally 刪掉用到的 blob，但工作還沒開始就被取消（\\cancel、關機）時 fn 不會執行，
+    所以 refs 要在這裡刪"""
+
+    def on_done(job):
+        if job.started_at is None:
+            delete_blobs(refs)
+        deliver_job_result(job)
+
+    try:
+        jobs.submit(user_id, kind, fn, *args, on_done=on_done)
+    except jobs.JobQueueFull:
+        return None
+    return ack
+
+
+# 比這個小的錄音檔讀進記憶體解碼，大的本來就在硬碟上，直接把路徑交給解碼器
+audio_in_memory_bytes = int(os.getenv("AUDIO_IN_MEMORY_BYTES", str(32 * 1024 * 1024)))
+
+
+def summarize_blobs(audio_ref, pdf_ref):
+    """背景工作：從 blob store 取出錄音檔和圖片整理成筆記，結束後刪掉 blob"""
+    try:
+        audio = None
+        if audio_ref:
+            audio = blobs.path(audio_ref) if blobs.size(audio_ref) > audio_in_memory_bytes else blobs.get(audio_ref)
+        bimg = blobs.get(pdf_ref) if pdf_ref else None
+        return speech_translate_summary(audio, bimg)
+    finally:
+        delete_blobs((audio_ref, pdf_ref))
+
+
+def build_form(audio_ref, user_id):
+    """背景工作：用錄音檔產生 Google 表單，回傳縮短後的表單連結"""
+    try:
+        token = token_store.get(user_id)
+        if token is None:
+            return "Google 授權已失效，請重新輸入 \\form 並授權一次！"
+        form_service = forms_client.get_service(
+            user_id, token["access_token"], token["refresh_token"], expiry_datetime(token)
+        )
+        form_url = make_form(blobs.path(audio_ref), form_service)
+    finally:
+        blobs.delete(audio_ref)
+    return shorten_url_by_reurl_api(form_url)
+
+
+def reset_session(user_id):
+    state = sessions.get(user_id)
+    delete_blobs((state["cs_audio"], state["cs_pdf"], state["pending_form"]))
+    sessions.reset(user_id)
+
+
+@app.get("/oauth/callback")
+async def oauth_callback(state: str, code: str = None, error: str = None):
+    """Google 授權完成後導回這裡：交換權杖後，接著處理授權前就送來的錄音檔；
+    使用者拒絕授權時 Google 會帶 error 回來，這時把等著的錄音檔刪掉"""
+    verified = token_store.verify_state(state)
+    if verified is None:
+        raise HTTPException(status_code=400, detail="Invalid state")
+    user_id, nonce = verified
+    if not await asyncio.to_thread(consume_auth_nonce, user_id, nonce):
+        raise HTTPException(status_code=400, detail="Invalid state")
+
+    if error or not code:
+        await asyncio.to_thread(drop_pending_form, user_id)
+        await line_client.push_text_async(user_id, "授權沒有完成，要產生表單請重新輸入 \\form 再傳一次錄音檔！")
+        return HTMLResponse("授權沒有完成，可以回到 LINE 了。")
+    try:
+        await asyncio.to_thread(token_store.exchange_code, user_id, code)
+    except Exception as e:
+        logger.warning(f"Failed to exchange code of {user_id}: {e}")
+        await asyncio.to_thread(drop_pending_form, user_id)
+        await line_client.push_text_async(user_id, "授權失敗，要產生表單請重新輸入 \\form 再傳一次錄音檔！")
+        raise HTTPException(status_code=400, detail="Failed to exchange code")
+    forms_client.forget(user_id)
+
+    # session 和 blob 都會碰到 Firebase / 硬碟，不要卡住 event loop
+    reply_msg = await asyncio.to_thread(resume_pending_form, user_id)
+    if reply_msg is not None:
+        await line_client.push_text_async(user_id, reply_msg)
+    return HTMLResponse("授權完成，可以回到 LINE 了！")
+
+
+# 同一個 worker 裡同時回來的 callback 只有一個能用掉 nonce
+auth_nonce_lock = threading.Lock()
+
+
+def consume_auth_nonce(user_id, nonce):
+    """nonce 跟最近一次發出的授權連結相同才算數，並且馬上作廢"""
+    with auth_nonce_lock:
+        if not nonce or sessions.get(user_id)["auth_nonce"] != nonce:
+            return False
+        sessions.update(user_id, auth_nonce=None)
+        return True
+
+
+def drop_pending_form(user_id):
+    audio_ref = sessions.get(user_id)["pending_form"]
+    if audio_ref:
+        blobs.delete(audio_ref)
+        sessions.update(user_id, pending_form=None)
+
+
+def resume_pending_form(user_id):
+    """授權前就送來的錄音檔排進背景工作，回傳要推給使用者的訊息；沒有的話回傳 None"""
+    session = sessions.get(user_id)
+    audio_ref = session["pending_form"]
+    if not audio_ref:
+        return None
+    reply_msg = start_job(
+        user_id,
+        "form",
+        build_form,
+        audio_ref,
+        user_id,
+        ack="授權完成，正在產生表單，完成後會傳給你！",
+        refs=(audio_ref,),
+    )
+    if reply_msg is None:
+        blobs.delete(audio_ref)
+        reply_msg = "授權完成，但目前處理中的工作太多，請稍後重新輸入 \\form 再傳一次錄音檔！"
+    sessions.update(user_id, pending_form=None)
+    return reply_msg
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "dispatcher": handler.stats(),
+        "jobs": {"pending": jobs.pending_count()},
+        "http": http_client.stats(),
+        "gemini": gemini.stats(),
+        # translation 很重，還沒載入的話不為了這裡 import
+        "translation_memo": sys.modules["translation"].memo_stats() if "translation" in sys.modules else None,
     }
-    response = requests.post(token_url, data=payload)
 
-    return response.json()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    metrics.QUEUE_DEPTH.labels("jobs").set(jobs.pending_count())
+    metrics.QUEUE_DEPTH.labels("dispatch").set(handler.stats()["queue_depth"])
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE_LATEST)
 
 
 @app.get("/health")
@@ -114,9 +362,27 @@ async def health():
     return "ok"
 
 
+@app.get("/ready")
+async def ready():
+    """READY_REQUIRES 列的子系統都好了才是 ready（預設只看 webhook），
+    沒列到的子系統只回報預載狀態，不影響結果"""
+    status = startup.status()
+    status["ready"] = startup.is_ready(ready_requires)
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+# 同時處理的海報數上限，超過的請求會排隊
+calendar_max_concurrency = int(os.getenv("CALENDAR_MAX_CONCURRENCY", "8"))
+calendar_semaphore = None
+
+
 @app.get("/")
 async def find_image_keyword(img_url: str):
-    image_data = check_image(img_url)
+    global calendar_semaphore
+    if calendar_semaphore is None:
+        calendar_semaphore = asyncio.Semaphore(calendar_max_concurrency)
+    async with calendar_semaphore:
+        image_data = await check_image_async(img_url)
     image_data = json.loads(image_data)
 
     g_url = create_gcal_url(
@@ -139,133 +405,86 @@ async def handle_callback(request: Request):
     body = await request.body()
     body = body.decode()
 
+    # 只驗證簽章，事件丟到背景處理後馬上回 200，避免 LINE 逾時重送
     try:
-        handler.handle(body, signature)
+        handler.dispatch(body, signature)
     except InvalidSignatureError:
         raise HTTPException(status_code=400, detail="Invalid signature")
 
+    return "OK"
+
 
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_text_message(event):
-    global CS_begin, CS_audio, CS_pdf, form_begin, authorization_code, access_token, refresh_token
     # loging part
     logging.info(event)
     text = event.message.text
     user_id = event.source.user_id
 
-    fdb = firebase.FirebaseApplication(firebase_url, None)
     user_chat_path = f"chat/{user_id}"
-    user_state_path = f"state/{user_id}"
-
-    conversation_data = fdb.get(user_chat_path, None)
-    user_state = fdb.get(user_state_path, None)
-
-    if conversation_data is None:
-        messages = []
-    else:
-        messages = conversation_data
+    state = sessions.get(user_id)
 
     if text == "C":
-        fdb.delete(user_chat_path, None)
-        fdb.delete(user_state_path, None)
+        with metrics.upstream("firebase", "delete_chat"):
+            fdb.delete(user_chat_path, None)
+        reset_session(user_id)
         reply_msg = "已清空對話紀錄"
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_msg)],
-                )
-            )
+        line_client.reply_text(event.reply_token, reply_msg)
     elif text == "選項":
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[
-                        TextMessage(
-                            text="Quick reply",
-                            quick_reply=QuickReply(
-                                items=[
-                                    QuickReplyItem(action=MessageAction(label="語音轉表單", text="\\form")),
-                                    QuickReplyItem(action=MessageAction(label="簡報轉摘要", text="\\pdfnote")),
-                                    QuickReplyItem(action=MessageAction(label="語音轉摘要", text="\\audnote")),
-                                    QuickReplyItem(action=MessageAction(label="生成文案", text="\\slogan")),
-                                ]
-                            ),
-                        )
-                    ],
-                )
-            )
+        line_client.reply_text(
+            event.reply_token,
+            "Quick reply",
+            quick_reply=QuickReply(
+                items=[
+                    QuickReplyItem(action=MessageAction(label="語音轉表單", text="\\form")),
+                    QuickReplyItem(action=MessageAction(label="簡報轉摘要", text="\\pdfnote")),
+                    QuickReplyItem(action=MessageAction(label="語音轉摘要", text="\\audnote")),
+                    QuickReplyItem(action=MessageAction(label="生成文案", text="\\slogan")),
+                ]
+            ),
+        )
     elif text == "\\slogan":
         reply_msg = "請依序輸入並以空白鍵隔開：主辦單位 時間 地點 活動名稱 活動內容 費用"
-        fdb.put_async(user_state_path, None, {"step": "awaiting_keyword"})
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_msg)],
-                )
-            )
+        sessions.update(user_id, step="awaiting_keyword")
+        line_client.reply_text(event.reply_token, reply_msg)
     elif text == "\\audnote":
-        CS_begin = True
+        sessions.update(user_id, cs_begin=True)
         reply_msg = "好的，請給我課程的錄音檔！"
         # fdb.put_async(user_state_path, None, {"step": "awaiting_audio"})
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_msg)],
-                )
-            )
+        line_client.reply_text(event.reply_token, reply_msg)
     elif text == "\\pdfnote":
-        CS_begin = True
+        sessions.update(user_id, cs_begin=True)
         reply_msg = "好的，請給我課程相關的截圖或圖片！"
         # fdb.put_async(user_state_path, None, {"step": "awaiting_pdf"})
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_msg)],
-                )
-            )
+        line_client.reply_text(event.reply_token, reply_msg)
     elif text == "\\form":
-        form_begin = True
+        sessions.update(user_id, form_begin=True)
         reply_msg = "好的，請給我音檔"
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_msg)],
-                )
-            )
+        line_client.reply_text(event.reply_token, reply_msg)
+
+    elif text == "\\cancel":
+        if jobs.cancel_user_jobs(user_id):
+            reply_msg = "已取消處理中的工作"
+        else:
+            reply_msg = "目前沒有處理中的工作"
+        line_client.reply_text(event.reply_token, reply_msg)
 
-    elif CS_begin and text == "n":
-        if CS_audio is None and CS_pdf is None:
+    elif state["cs_begin"] and text == "n":
+        if state["cs_audio"] is None and state["cs_pdf"] is None:
             reply_msg = "想整理社課筆記的話，請先提供錄音檔或圖片！"
         else:
-            summary = speech_translate_summary(CS_audio, CS_pdf)
-            CS_begin = False
-            CS_audio = None
-            CS_pdf = None
-            reply_msg = summary
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_msg)],
-                )
-            )
+            refs = (state["cs_audio"], state["cs_pdf"])
+            reply_msg = start_job(user_id, "summary", summarize_blobs, *refs, refs=refs)
+            if reply_msg is None:
+                # 檔案留在 session 裡，稍後再輸入 n 就好
+                reply_msg = BUSY_MESSAGE
+            else:
+                sessions.update(user_id, cs_begin=False, cs_audio=None, cs_pdf=None)
+        line_client.reply_text(event.reply_token, reply_msg)
 
-    elif user_state["step"] == "awaiting_keyword":
+    elif state["step"] == "awaiting_keyword":
         # 收集到關鍵字，要求輸入主題1
-        fdb.delete(user_state_path, None)
+        sessions.update(user_id, step=None)
         reply_msg = "開始生成文宣，請稍等..."
         parts = text.split(" ", 5)
         organizer, time, location, event_name, description, fee = parts
@@ -278,26 +497,12 @@ def handle_text_message(event):
         event_text = generate_promotion_data(organizer, time, location, event_name, description, fee)
 
         reply_msg = f"文宣內容: {event_text}"
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_msg)],
-                )
-            )
+        line_client.reply_text(event.reply_token, reply_msg)
 
     else:
         reply_msg = "請輸入有效命令，例如： 主辦單位 時間 地點 活動名稱 活動內容 費用"
 
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_msg)],
-                )
-            )
+        line_client.reply_text(event.reply_token, reply_msg)
 
     return "OK"
 
@@ -305,144 +510,96 @@ def handle_text_message(event):
 @handler.add(MessageEvent, message=ImageMessageContent)
 def handle_img_message(event):
     image_content = b""
-    with ApiClient(configuration) as api_client:
-        line_bot_blob_api = MessagingApiBlob(api_client)
-        image_content = line_bot_blob_api.get_message_content(event.message.id)
-
-    global CS_begin, CS_pdf, CS_audio
-
-    if CS_begin and CS_audio is not None:
-        CS_pdf = image_content
-        summary = speech_translate_summary(CS_audio, CS_pdf)
-        CS_begin = False
-        CS_audio = None
-        CS_pdf = None
-        reply_msg = summary
-    elif CS_begin:
-        CS_pdf = image_content
+    image_content = line_client.get_message_content(event.message.id)
+
+    user_id = event.source.user_id
+    state = sessions.get(user_id)
+
+    if state["cs_begin"] and state["cs_audio"] is not None:
+        refs = (state["cs_audio"], blobs.put(image_content))
+        reply_msg = start_job(user_id, "summary", summarize_blobs, *refs, refs=refs)
+        if reply_msg is None:
+            # 圖片先存進 session，稍後再輸入 n 就好
+            delete_blobs((state["cs_pdf"],))
+            sessions.update(user_id, cs_pdf=refs[1])
+            reply_msg = BUSY_MESSAGE
+        else:
+            sessions.update(user_id, cs_begin=False, cs_audio=None, cs_pdf=None)
+    elif state["cs_begin"]:
+        if state["cs_pdf"]:
+            blobs.delete(state["cs_pdf"])
+        sessions.update(user_id, cs_pdf=blobs.put(image_content))
         reply_msg = '已收到圖片，如果有的話，請給我課程的錄音檔！\n如果沒有，請輸入"n"告訴我～'
     else:
         reply_msg = "你想做什麼呢？如果想整理社課筆記，請先點選「上傳圖片」！"
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message(
-            ReplyMessageRequest(replyToken=event.reply_token, messages=[TextMessage(text=reply_msg)])
-        )
+    line_client.reply_text(event.reply_token, reply_msg)
     return "OK"
 
 
 @handler.add(MessageEvent, message=AudioMessageContent)
 def handle_audio_message(event):
-    global CS_begin, CS_audio, CS_pdf, form_begin, access_token, refresh_token
-    if form_begin:
-        user_id = event.source.user_id
-        if not access_token:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        replyToken=event.reply_token,
-                        messages=[TextMessage(text=f"請點擊以下連結進行授權：{shorten_url_by_reurl_api(auth_url)}")],
-                    )
-                )
-
-            response = requests.get("https://685d-60-251-196-41.ngrok-free.app/get_token")
-            # 檢查是否成功取得授權碼
-            if response.status_code == 200:
-                authorization_code = response.json().get("authorization_code")
-                if not authorization_code:
-                    raise Exception("Authorization code not found in response.")
-            else:
-                raise Exception(f"Failed to get authorization code: {response.text}")
-
-            # 用授權碼交換存取權杖
-            token_data = exchange_code_for_token(authorization_code)
-
-            access_token = token_data.get("access_token")
-            refresh_token = token_data.get("refresh_token")
-
-            if not access_token or not refresh_token:
-                raise ValueError("Access or refresh token missing.")
-
-        creds = Credentials(
-            token=access_token,
-            refresh_token=refresh_token,
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=client_id,
-            client_secret=client_secret,
-            scopes=["https://www.googleapis.com/auth/forms.body", "https://www.googleapis.com/auth/drive"],
-        )
-        try:
-            creds.refresh(Req())
-        except Exception as e:
-            print(f"Failed to refresh token: {e}")
-
-        # 使用憑證初始化 form_service 物件
-        global form_service
-        form_service = build("forms", "v1", credentials=creds, static_discovery=False)
-
+    user_id = event.source.user_id
+    state = sessions.get(user_id)
+    if state["form_begin"]:
         # 下載語音訊息檔案
         audio_message_id = event.message.id
 
-        with ApiClient(configuration) as api_client:
-            line_bot_blob_api = MessagingApiBlob(api_client)
-            audio_content = line_bot_blob_api.get_message_content(audio_message_id)
-
-        # 將 M4A 轉成 MP3
-        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as temp_audio_file:
-            temp_audio_file.write(audio_content)
-            mp3_path = temp_audio_file.name
-
-        # 發送語音檔案給 Gemini API，回傳表單連結
-        form_url = make_form(mp3_path, form_service, access_token)
-        reply_msg = shorten_url_by_reurl_api(form_url)
-
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.push_message(PushMessageRequest(to=user_id, messages=[TextMessage(text=reply_msg)]))
-        form_begin = False
-
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_msg)],
-                )
+        audio_content = line_client.get_message_content(audio_message_id)
+        audio_ref = blobs.put(audio_content)
+
+        if token_store.get(user_id) is None:
+            # 還沒授權：先把錄音檔存起來，授權完成後由 /oauth/callback 接著產生表單
+            if state["pending_form"]:
+                blobs.delete(state["pending_form"])
+            # 每次都發新的 nonce，之前的授權連結就失效了
+            nonce = secrets.token_urlsafe(16)
+            sessions.update(user_id, form_begin=False, pending_form=audio_ref, auth_nonce=nonce)
+            auth_url = shorten_url_by_reurl_api(make_auth_url(user_id, nonce))
+            reply_msg = f"請點擊以下連結進行授權，完成後會自動產生表單：{auth_url}"
+        else:
+            # 發送語音檔案給 Gemini API，回傳表單連結
+            reply_msg = start_job(
+                user_id,
+                "form",
+                build_form,
+                audio_ref,
+                user_id,
+                ack="正在產生表單，完成後會傳給你！",
+                refs=(audio_ref,),
             )
+            if reply_msg is None:
+                # 保留 form_begin，稍後直接再傳一次錄音檔
+                blobs.delete(audio_ref)
+                reply_msg = BUSY_MESSAGE
+            else:
+                sessions.update(user_id, form_begin=False)
 
+        line_client.reply_text(event.reply_token, reply_msg)
         return "OK"
 
-    else:
-        with ApiClient(configuration) as api_client:
-            line_bot_blob_api = MessagingApiBlob(api_client)
-            audio_content = line_bot_blob_api.get_message_content(event.message.id)
-        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as temp_audio_file:
-            temp_audio_file.write(audio_content)
-            audio_content = temp_audio_file.name
-
-    if CS_begin and CS_pdf is not None:
-        CS_audio = audio_content
-        summary = speech_translate_summary(CS_audio, CS_pdf)
-        CS_begin = False
-        CS_audio = None
-        CS_pdf = None
-        reply_msg = summary
-    elif CS_begin:
-        CS_audio = audio_content
+    elif state["cs_begin"]:
+        audio_content = line_client.get_message_content(event.message.id)
+
+    if state["cs_begin"] and state["cs_pdf"] is not None:
+        refs = (blobs.put(audio_content), state["cs_pdf"])
+        reply_msg = start_job(user_id, "summary", summarize_blobs, *refs, refs=refs)
+        if reply_msg is None:
+            # 錄音檔先存進 session，稍後再輸入 n 就好
+            delete_blobs((state["cs_audio"],))
+            sessions.update(user_id, cs_audio=refs[0])
+            reply_msg = BUSY_MESSAGE
+        else:
+            sessions.update(user_id, cs_begin=False, cs_audio=None, cs_pdf=None)
+    elif state["cs_begin"]:
+        if state["cs_audio"]:
+            blobs.delete(state["cs_audio"])
+        sessions.update(user_id, cs_audio=blobs.put(audio_content))
         reply_msg = '已收到錄音檔，如果有的話，請給我課程相關的截圖或圖片！\n如果沒有，請輸入"n"告訴我～'  # \n(目前尚未支援上傳pdf檔，請輸入任意字元繼續)
     else:
         reply_msg = "你想做什麼呢？如果想整理社課筆記，請先點選「上傳音檔」！"
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=reply_msg)],
-            )
-        )
+    line_client.reply_text(event.reply_token, reply_msg)
 
     return "OK"
 
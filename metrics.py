@@ -0,0 +1,89 @@
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# 整段流程的步驟從幾十毫秒到十幾分鐘（長錄音轉錄）都有
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+UPSTREAM_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_SECONDS = Histogram(
+    "pipeline_stage_seconds", "Time spent in each pipeline stage", ["stage"], buckets=STAGE_BUCKETS
+)
+STAGE_IN_FLIGHT = Gauge("pipeline_stage_in_flight", "Pipeline stages currently running", ["stage"])
+STAGE_ERRORS = Counter("pipeline_stage_errors_total", "Pipeline stages that raised", ["stage"])
+
+UPSTREAM_SECONDS = Histogram(
+    "upstream_request_seconds",
+    "Latency of calls to external services",
+    ["upstream", "operation"],
+    buckets=UPSTREAM_BUCKETS,
+)
+UPSTREAM_IN_FLIGHT = Gauge("upstream_requests_in_flight", "Calls to external services currently waiting", ["upstream"])
+UPSTREAM_ERRORS = Counter("upstream_errors_total", "Failed calls to external services", ["upstream", "operation"])
+
+WHISPER_AUDIO_SECONDS = Counter("whisper_audio_seconds_total", "Seconds of audio transcribed")
+WHISPER_PROCESSING_SECONDS = Counter("whisper_processing_seconds_total", "Wall-clock seconds spent transcribing")
+WHISPER_RTF = Histogram(
+    "whisper_real_time_factor",
+    "Processing seconds per second of audio",
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 4),
+)
+
+TRANSLATION_MEMO_LOOKUPS = Counter(
+    "translation_memo_lookups_total", "Sentence lookups in the translation memory", ["result"]
+)
+
+QUEUE_DEPTH = Gauge("queue_depth", "Work waiting in the in-process queues", ["queue"])
+
+
+def observe_stage(name, seconds, error=False):
+    STAGE_SECONDS.labels(name).observe(seconds)
+    if error:
+        STAGE_ERRORS.labels(name).inc()
+
+
+@contextmanager
+def stage(name):
+    """記錄一個步驟花的時間、同時有幾個在跑、失敗次數"""
+    STAGE_IN_FLIGHT.labels(name).inc()
+    start = time.perf_counter()
+    error = True
+    try:
+        yield
+        error = False
+    finally:
+        STAGE_IN_FLIGHT.labels(name).dec()
+        observe_stage(name, time.perf_counter() - start, error)
+
+
+def observe_upstream(name, operation, seconds, error=False):
+    UPSTREAM_SECONDS.labels(name, operation).observe(seconds)
+    if error:
+        UPSTREAM_ERRORS.labels(name, operation).inc()
+
+
+@contextmanager
+def upstream(name, operation):
+    """包住一次對外部服務（LINE、Gemini、Vertex、Firebase、Forms…）的呼叫，丟出例外就算失敗"""
+    UPSTREAM_IN_FLIGHT.labels(name).inc()
+    start = time.perf_counter()
+    error = True
+    try:
+        yield
+        error = False
+    finally:
+        UPSTREAM_IN_FLIGHT.labels(name).dec()
+        observe_upstream(name, operation, time.perf_counter() - start, error)
+
+
+def record_transcription(audio_seconds, processing_seconds):
+    WHISPER_AUDIO_SECONDS.inc(audio_seconds)
+    WHISPER_PROCESSING_SECONDS.inc(processing_seconds)
+    if audio_seconds > 0:
+        WHISPER_RTF.observe(processing_seconds / audio_seconds)
+
+
+def render():
+    """Prometheus text format，給 /metrics 用"""
+    return generate_latest()
@@ -0,0 +1,191 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from firebase import firebase
+
+import metrics
+
+logger = logging.getLogger(__file__)
+
+# 多個 worker 時別的 worker 寫入的狀態要馬上看得到，所以預設不快取；
+# 代價是每則訊息都要同步讀一次 Firebase，只有單一 worker 才省得掉這次讀取
+web_concurrency = int(os.getenv("WEB_CONCURRENCY", "1"))
+session_ttl = float(os.getenv("SESSION_CACHE_TTL", "30" if web_concurrency <= 1 else "0"))
+# 寫入 Firebase 失敗時，隔多久重試一次
+session_flush_interval = float(os.getenv("SESSION_FLUSH_INTERVAL", "0.5"))
+# 多個 worker 時要指到共用的目錄
+blob_dir = os.getenv("SESSION_BLOB_DIR", os.path.join(tempfile.gettempdir(), "linebot-blobs"))
+
+DEFAULT_STATE = {
+    "step": None,
+    "cs_begin": False,
+    "cs_audio": None,
+    "cs_pdf": None,
+    "form_begin": False,
+    # 等 Google 授權完成才產生表單的錄音檔，以及這次授權連結的 nonce
+    "pending_form": None,
+    "auth_nonce": None,
+}
+
+
+class BlobStore:
+    """圖片、音檔等大型資料存成檔案，session 裡只放檔名當作 reference"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, ref):
+        return os.path.join(self.root, ref)
+
+    def put(self, data):
+        ref = uuid.uuid4().hex
+        tmp_path = f"{self.path(ref)}.tmp"
+        with metrics.stage("blob.write"):
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(ref))
+        return ref
+
+    def size(self, ref):
+        return os.path.getsize(self.path(ref))
+
+    def get(self, ref):
+        with metrics.stage("blob.read"), open(self.path(ref), "rb") as f:
+            return f.read()
+
+    def delete(self, ref):
+        try:
+            os.remove(self.path(ref))
+        except FileNotFoundError:
+            pass
+
+
+class SessionStore:
+    """以 user_id 為 key 的對話狀態。讀取走 process 內的 TTL 快取，
+    寫入只把改到的欄位 PATCH 到 Firebase（write-through），同時更新的不同欄位不會互相蓋掉；
+    寫入失敗的欄位才交給背景 thread 重試"""
+
+    def __init__(self, firebase_url, ttl=session_ttl, flush_interval=session_flush_interval):
+        self._fdb = firebase.FirebaseApplication(firebase_url, None) if firebase_url else None
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._entries = {}
+        # user_id -> 還沒寫進 Firebase 的欄位
+        self._dirty = {}
+        # user_id -> 寫入次數，用來判斷載入期間有沒有人寫入
+        self._versions = {}
+        # 同一個使用者的寫入一次一個，重試時才不會用舊值蓋掉新的
+        self._write_locks = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop, name="session-flush", daemon=True)
+        self._flusher.start()
+
+    def _load(self, user_id):
+        state = None
+        if self._fdb is not None:
+            try:
+                with metrics.upstream("firebase", "get_state"):
+                    state = self._fdb.get(f"state/{user_id}", None)
+            except Exception as e:
+                logger.warning(f"Failed to load session of {user_id}: {e}")
+        return {**DEFAULT_STATE, **(state or {})}
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                return dict(entry[0])
+            version = self._versions.get(user_id, 0)
+
+        state = self._load(user_id)
+        with self._lock:
+            # 還沒寫進 Firebase 的欄位蓋在讀到的狀態上
+            state.update(self._dirty.get(user_id, {}))
+            # 載入期間有人寫入的話，讀到的可能是舊的，不放進快取
+            if self._versions.get(user_id, 0) == version:
+                self._entries[user_id] = (state, time.monotonic())
+        return dict(state)
+
+    def _write_lock(self, user_id):
+        with self._lock:
+            return self._write_locks.setdefault(user_id, threading.Lock())
+
+    def update(self, user_id, **changes):
+        with self._write_lock(user_id):
+            with self._lock:
+                entry = self._entries.get(user_id)
+                if entry is not None:
+                    self._entries[user_id] = ({**entry[0], **changes}, entry[1])
+            persisted = self._persist(user_id, changes)
+            with self._lock:
+                # 寫完才加，寫入期間開始的載入也不會被放進快取
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+                if persisted:
+                    # 之前寫入失敗、還在等重試的同一個欄位已經是舊值了
+                    self._forget_dirty(user_id, changes)
+                else:
+                    self._dirty.setdefault(user_id, {}).update(changes)
+        if not persisted:
+            self._wakeup.set()
+
+    def _forget_dirty(self, user_id, changes):
+        pending = self._dirty.get(user_id, {})
+        for key in changes:
+            pending.pop(key, None)
+        if not pending:
+            self._dirty.pop(user_id, None)
+
+    def reset(self, user_id):
+        self.update(user_id, **DEFAULT_STATE)
+
+    def _persist(self, user_id, changes):
+        if self._fdb is None:
+            return True
+        try:
+            with metrics.upstream("firebase", "patch_state"):
+                if changes == DEFAULT_STATE:
+                    self._fdb.delete("state", user_id)
+                else:
+                    # 值是 None 的欄位 Firebase 會直接刪掉，讀回來時補上預設值
+                    self._fdb.patch(f"state/{user_id}", changes)
+        except Exception as e:
+            logger.warning(f"Failed to persist session of {user_id}: {e}")
+            return False
+        return True
+
+    def flush(self):
+        with self._lock:
+            user_ids = list(self._dirty)
+
+        for user_id in user_ids:
+            with self._write_lock(user_id):
+                # 拿到鎖之前可能已經有新的寫入成功，要重新看一次還剩哪些欄位
+                with self._lock:
+                    changes = dict(self._dirty.get(user_id, {}))
+                if not changes:
+                    continue
+                persisted = self._persist(user_id, changes)
+                if persisted:
+                    with self._lock:
+                        self._forget_dirty(user_id, changes)
+            if not persisted:
+                self._wakeup.set()
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import cache
+import http_client
+
+logger = logging.getLogger(__file__)
+
+reurl_cache_ttl = float(os.getenv("REURL_CACHE_TTL", str(30 * 24 * 3600)))
+reurl_cache_size = int(os.getenv("REURL_CACHE_SIZE", "1024"))
+# 有設定才會多一層存在硬碟的快取
+reurl_cache_path = os.getenv("REURL_CACHE_PATH", "")
+reurl_timeout = float(os.getenv("REURL_TIMEOUT", "3"))
+
+_memory = OrderedDict()
+_inflight = {}
+_lock = threading.Lock()
+_disk = None
+
+
+def _disk_cache():
+    global _disk
+    if reurl_cache_path and _disk is None:
+        _disk = cache.DiskCache(reurl_cache_path, 16 * 1024 * 1024)
+    return _disk
+
+
+def _remember(long_url, short_url, expires_at):
+    with _lock:
+        _memory[long_url] = (short_url, expires_at)
+        _memory.move_to_end(long_url)
+        while len(_memory) > reurl_cache_size:
+            _memory.popitem(last=False)
+
+
+def _load_from_disk(long_url):
+    disk = _disk_cache()
+    if disk is None:
+        return None
+    value = disk.get(f"reurl:{long_url}")
+    if value is None:
+        return None
+    entry = json.loads(value)
+    if entry["expires_at"] <= time.time():
+        return None
+    _remember(long_url, entry["short_url"], entry["expires_at"])
+    return entry["short_url"]
+
+
+def _fetch(long_url):
+    response = http_client.post(
+        "https://api.reurl.cc/shorten",
+        endpoint="reurl.shorten",
+        retries=1,
+        timeout=(reurl_timeout, reurl_timeout),
+        headers={
+            "Content-Type": "application/json",
+            "reurl-api-key": os.getenv("REURL_API_KEY"),
+        },
+        data=json.dumps({"url": long_url}),
+    )
+    logger.info(response.json())
+    short_url = response.json()["short_url"]
+
+    expires_at = time.time() + reurl_cache_ttl
+    _remember(long_url, short_url, expires_at)
+    disk = _disk_cache()
+    if disk is not None:
+        disk.put(f"reurl:{long_url}", json.dumps({"short_url": short_url, "expires_at": expires_at}))
+    return short_url
+
+
+def shorten(long_url):
+    """縮網址：先查記憶體 LRU、再查硬碟，最後才呼叫 reurl。
+    同一個網址同時只會打一次 reurl；reurl 失敗時直接回傳原本的網址"""
+    with _lock:
+        hit = _memory.get(long_url)
+        if hit is not None and hit[1] > time.time():
+            _memory.move_to_end(long_url)
+            return hit[0]
+        future = _inflight.get(long_url)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inflight[long_url] = future
+
+    if not leader:
+        return future.result()
+
+    short_url = long_url
+    try:
+        short_url = _load_from_disk(long_url) or _fetch(long_url)
+    except Exception as e:
+        logger.warning(f"Failed to shorten url, using the long one: {e}")
+    finally:
+        with _lock:
+            del _inflight[long_url]
+        future.set_result(short_url)
+    return short_url
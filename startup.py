@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__file__)
+
+PENDING = "pending"
+READY = "ready"
+FAILED = "failed"
+
+process_started = time.perf_counter()
+
+_subsystems = {}
+_timings = {}
+_lock = threading.Lock()
+
+
+@contextmanager
+def timed(name):
+    """記錄一段啟動步驟（例如 import）花了多久"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _lock:
+            _timings[name] = round(time.perf_counter() - start, 4)
+
+
+def mark(name, status, seconds=None, error=None):
+    with _lock:
+        _subsystems[name] = {
+            "status": status,
+            "seconds": None if seconds is None else round(seconds, 4),
+            "error": None if error is None else str(error),
+        }
+
+
+def warm_up(name, fn):
+    """在背景 thread 預先載入比較重的子系統，不擋住 app 開始接 webhook"""
+    mark(name, PENDING)
+
+    def run():
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            logger.warning(f"Failed to warm up {name}: {e}")
+            mark(name, FAILED, time.perf_counter() - start, e)
+        else:
+            mark(name, READY, time.perf_counter() - start)
+            logger.info(f"{name} ready in {time.perf_counter() - start:.2f}s")
+
+    threading.Thread(target=run, name=f"warm-up-{name}", daemon=True).start()
+
+
+def is_ready(names):
+    with _lock:
+        return all(_subsystems.get(name, {}).get("status") == READY for name in names)
+
+
+def status():
+    with _lock:
+        return {
+            "uptime_seconds": round(time.perf_counter() - process_started, 4),
+            "timings": dict(_timings),
+            "subsystems": {name: dict(info) for name, info in _subsystems.items()},
+        }
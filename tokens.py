@@ -0,0 +1,175 @@
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+
+from firebase import firebase
+
+import http_client
+import metrics
+
+logger = logging.getLogger(__file__)
+
+token_uri = "https://oauth2.googleapis.com/token"
+# Fernet key（urlsafe base64 的 32 bytes），一定要設定，換了 key 舊的權杖就解不開
+token_encryption_key = os.getenv("TOKEN_ENCRYPTION_KEY")
+# 背景每隔多久檢查一次，剩不到多少秒就先 refresh
+token_refresh_interval = float(os.getenv("TOKEN_REFRESH_INTERVAL", "60"))
+token_refresh_margin = float(os.getenv("TOKEN_REFRESH_MARGIN", "600"))
+# 授權連結（OAuth state）發出後多久內有效
+oauth_state_ttl = float(os.getenv("OAUTH_STATE_TTL", "600"))
+
+
+class TokenStore:
+    """每個使用者各自的 Google OAuth 權杖。加密後存在 Firebase tokens/{user_id}，
+    記憶體裡留一份；背景 thread 會在權杖過期前先 refresh，表單流程不用等"""
+
+    def __init__(self, firebase_url, client_id, client_secret, redirect_uri, key=token_encryption_key):
+        from cryptography.fernet import Fernet
+
+        if not key:
+            raise ValueError("TOKEN_ENCRYPTION_KEY is required to encrypt stored tokens")
+        self._fernet = Fernet(key)
+        self._state_secret = hashlib.sha256(key if isinstance(key, bytes) else key.encode()).digest()
+        self._fdb = firebase.FirebaseApplication(firebase_url, None) if firebase_url else None
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+
+    # OAuth state 參數：帶著 user_id、發出時間和 nonce 並簽章，callback 回來時才知道是誰授權的；
+    # nonce 由呼叫端存起來，比對過一次就丟掉，同一個連結不能重複使用
+    def _sign(self, payload):
+        return hmac.new(self._state_secret, payload.encode(), hashlib.sha256).hexdigest()
+
+    def make_state(self, user_id, nonce):
+        payload = f"{user_id}.{int(time.time())}.{nonce}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify_state(self, state, max_age=oauth_state_ttl):
+        """簽章正確且還沒過期的話回傳 (user_id, nonce)，否則回傳 None"""
+        payload, _, signature = state.rpartition(".")
+        if not payload or not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        user_id, issued_at, nonce = payload.split(".")
+        if not 0 <= time.time() - int(issued_at) <= max_age:
+            return None
+        return user_id, nonce
+
+    def get(self, user_id):
+        """回傳 {"access_token", "refresh_token", "expiry"}，expiry 是 epoch 秒；沒有授權過回傳 None"""
+        with self._lock:
+            token = self._tokens.get(user_id)
+        if token is not None or self._fdb is None:
+            return token
+
+        try:
+            with metrics.upstream("firebase", "get_token"):
+                encrypted = self._fdb.get(f"tokens/{user_id}", None)
+        except Exception as e:
+            logger.warning(f"Failed to load token of {user_id}: {e}")
+            return None
+        if not encrypted:
+            return None
+        try:
+            token = json.loads(self._fernet.decrypt(encrypted.encode()))
+        except Exception as e:
+            logger.warning(f"Failed to decrypt token of {user_id}: {e}")
+            return None
+        with self._lock:
+            self._tokens.setdefault(user_id, token)
+        return token
+
+    def _save(self, user_id, token_data):
+        old = self.get(user_id) or {}
+        token = {
+            "access_token": token_data["access_token"],
+            # refresh 的回應不一定會帶新的 refresh_token
+            "refresh_token": token_data.get("refresh_token") or old.get("refresh_token"),
+            "expiry": time.time() + token_data.get("expires_in", 3600),
+        }
+        with self._lock:
+            self._tokens[user_id] = token
+        if self._fdb is not None:
+            try:
+                encrypted = self._fernet.encrypt(json.dumps(token).encode()).decode()
+                with metrics.upstream("firebase", "put_token"):
+                    self._fdb.put("tokens", user_id, encrypted)
+            except Exception as e:
+                logger.warning(f"Failed to persist token of {user_id}: {e}")
+        return token
+
+    def exchange_code(self, user_id, code):
+        """交換授權碼換取存取權杖"""
+        payload = {
+            "code": code,
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "redirect_uri": self.redirect_uri,
+            "grant_type": "authorization_code",
+        }
+        # 授權碼只能用一次，不重試
+        response = http_client.post(token_uri, endpoint="google.oauth.token", retries=0, data=payload)
+        token_data = response.json()
+        if not token_data.get("access_token") or not token_data.get("refresh_token"):
+            raise ValueError(f"Access or refresh token missing: {token_data.get('error')}")
+        return self._save(user_id, token_data)
+
+    def refresh(self, user_id):
+        token = self.get(user_id)
+        payload = {
+            "refresh_token": token["refresh_token"],
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "grant_type": "refresh_token",
+        }
+        response = http_client.post(token_uri, endpoint="google.oauth.refresh", data=payload)
+        token_data = response.json()
+        if token_data.get("error") == "invalid_grant":
+            # 使用者撤銷授權了，下次要重新授權
+            self.delete(user_id)
+        if response.status_code != 200 or not token_data.get("access_token"):
+            raise ValueError(f"Failed to refresh token: {token_data.get('error')}")
+        return self._save(user_id, token_data)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._tokens.pop(user_id, None)
+        if self._fdb is not None:
+            with metrics.upstream("firebase", "delete_token"):
+                self._fdb.delete("tokens", user_id)
+
+    def _refresh_loop(self):
+        while not self._stop.wait(token_refresh_interval):
+            with self._lock:
+                expiring = [
+                    user_id
+                    for user_id, token in self._tokens.items()
+                    if token["expiry"] - time.time() < token_refresh_margin
+                ]
+            for user_id in expiring:
+                try:
+                    self.refresh(user_id)
+                    logger.info(f"refreshed token of {user_id}")
+                except Exception as e:
+                    logger.warning(f"Failed to refresh token of {user_id}: {e}")
+
+    def start(self):
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="token-refresh", daemon=True)
+            self._refresher.start()
+
+    def close(self):
+        self._stop.set()
+
+
+def expiry_datetime(token):
+    """google Credentials 用的 expiry（naive UTC datetime）"""
+    return datetime.datetime.utcfromtimestamp(token["expiry"])
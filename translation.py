@@ -1,31 +1,251 @@
+import logging
 import os
+import re
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part, SafetySetting
 
+import cache
+import metrics
+
+logger = logging.getLogger(__file__)
+
 YOUR_PROJECT_NAME = os.getenv("PROJECT_NAME")
 
+model_name = "gemini-1.5-flash"
+# 修改翻譯 prompt 時要跟著改版本號，讓舊的快取失效
+prompt_version = "2"
+
+# 每次送去翻譯的原文大約多少 token，同時最多送幾個
+translate_chunk_tokens = int(os.getenv("TRANSLATE_CHUNK_TOKENS", "1500"))
+translate_workers = int(os.getenv("TRANSLATE_WORKERS", "4"))
+
+# 句子層級的翻譯記憶，重複出現的句子不用再翻一次；設成空字串就關掉
+translation_memo_path = os.getenv("TRANSLATION_MEMO_PATH", ".cache/translation_memo.sqlite3")
+translation_memo_max_bytes = int(os.getenv("TRANSLATION_MEMO_MAX_BYTES", str(64 * 1024 * 1024)))
+target_language = "zh-TW"
+
+_executor = ThreadPoolExecutor(max_workers=translate_workers, thread_name_prefix="translate")
+_memo = None
+_memo_stats = {"hits": 0, "misses": 0}
+_models = {}
+_initialized = False
+_lock = threading.Lock()
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?。！？])\s+|\n+")
+NUMBERED_LINE = re.compile(r"^\s*\[(\d+)\]\s*(.*)$")
+SENTENCE_END = re.compile(r"[.!?。！？]\s*$")
+
+
+def get_model(project_name, model_name=model_name):
+    """vertexai.init 只做一次，同一個模型只建立一次"""
+    global _initialized
+    with _lock:
+        if not _initialized:
+            vertexai.init(project=project_name, location="us-central1")
+            _initialized = True
+        model = _models.get(model_name)
+        if model is None:
+            model = _models[model_name] = GenerativeModel(model_name)
+        return model
+
+
+def estimate_tokens(text):
+    # 英文大約 4 個字元一個 token，中日韓文字大約一個字一個 token
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    return ascii_chars / 4 + (len(text) - ascii_chars)
 
-def translate_text_from_vertexAI(text, project_name, model_name="gemini-1.5-flash"):
-    vertexai.init(project=project_name, location="us-central1")
-    model = GenerativeModel(model_name)
-    responses = model.generate_content(
-        [f"Translate the following text to Traditional Chinese.\n{text}"],
-        generation_config={
-            "max_output_tokens": 2000,
-            "temperature": 0.0,
-            "top_p": 1.0,
-        },
-    )
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+
+
+def split_chunks(sentences, max_tokens=translate_chunk_tokens):
+    """把句子依序裝進不超過 max_tokens 的 chunk，太長的單句再依空白切開"""
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    for sentence in sentences:
+        pieces = [sentence]
+        if estimate_tokens(sentence) > max_tokens:
+            words = sentence.split(" ")
+            step = max(1, int(len(words) * max_tokens / estimate_tokens(sentence)))
+            pieces = [" ".join(words[i : i + step]) for i in range(0, len(words), step)]
+
+        for piece in pieces:
+            tokens = estimate_tokens(piece)
+            if chunk and chunk_tokens + tokens > max_tokens:
+                chunks.append("\n".join(chunk))
+                chunk = []
+                chunk_tokens = 0
+            chunk.append(piece)
+            chunk_tokens += tokens
+    if chunk:
+        chunks.append("\n".join(chunk))
+    return chunks
+
+
+def translate_text_from_vertexAI(text, project_name, model_name=model_name):
+    model = get_model(project_name, model_name)
+    with metrics.upstream("vertex", model_name):
+        responses = model.generate_content(
+            [f"Translate the following text to Traditional Chinese.\n{text}"],
+            generation_config={
+                "max_output_tokens": 8192,
+                "temperature": 0.0,
+                "top_p": 1.0,
+            },
+        )
 
     return responses.candidates[0].text
 
 
+def _get_memo():
+    global _memo
+    if translation_memo_path and _memo is None:
+        with _lock:
+            if _memo is None:
+                _memo = cache.DiskCache(translation_memo_path, translation_memo_max_bytes)
+    return _memo
+
+
+def _memo_key(sentence):
+    normalized = " ".join(unicodedata.normalize("NFKC", sentence).split())
+    return cache.content_key("translation-memo", normalized, target_language, model_name, prompt_version)
+
+
+def _memo_get(sentence):
+    memo = _get_memo()
+    translated = memo.get(_memo_key(sentence)) if memo is not None else None
+    with _lock:
+        _memo_stats["hits" if translated is not None else "misses"] += 1
+    metrics.TRANSLATION_MEMO_LOOKUPS.labels("hit" if translated is not None else "miss").inc()
+    return translated
+
+
+def _memo_put(sentence, translated):
+    memo = _get_memo()
+    if memo is not None:
+        memo.put(_memo_key(sentence), translated)
+
+
+def memo_stats():
+    with _lock:
+        stats = dict(_memo_stats)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / total if total else 0.0
+    return stats
+
+
+def translate_numbered(sentences, positions=None):
+    """一次翻譯多個句子，每句加上編號以便對回原句；回傳每句的翻譯。
+    模型沒有照編號回答時，positions（每句在全文中的位置）連續的幾句才一起翻，
+    翻譯放在那段第一句、其餘留空，不寫進翻譯記憶"""
+    text = "\n".join(f"[{i}] {sentence}" for i, sentence in enumerate(sentences))
+    model = get_model(YOUR_PROJECT_NAME)
+    with metrics.upstream("vertex", model_name):
+        responses = model.generate_content(
+            [
+                "Translate each numbered line to Traditional Chinese. "
+                "Keep the [number] prefix and output exactly one line per input line.\n" + text
+            ],
+            generation_config={
+                "max_output_tokens": 8192,
+                "temperature": 0.0,
+                "top_p": 1.0,
+            },
+        )
+
+    translated = {}
+    for line in responses.candidates[0].text.splitlines():
+        match = NUMBERED_LINE.match(line)
+        if match:
+            translated[int(match.group(1))] = match.group(2).strip()
+    if sorted(translated) != list(range(len(sentences))):
+        logger.info("numbered translation did not line up, translating consecutive sentences as a whole")
+        if positions is None:
+            positions = range(len(sentences))
+        results = []
+        # 中間夾著翻譯記憶命中的句子時要分開翻，不然那幾句的翻譯會跑到後面去
+        for _, run in groupby(enumerate(positions), key=lambda item: item[1] - item[0]):
+            run = [sentences[i] for i, _ in run]
+            results.append(translate_text_from_vertexAI("\n".join(run), YOUR_PROJECT_NAME))
+            results.extend([""] * (len(run) - 1))
+        return results
+
+    results = [translated[i] for i in range(len(sentences))]
+    for sentence, result in zip(sentences, results):
+        _memo_put(sentence, result)
+    return results
+
+
+class _SentenceTranslator:
+    """一句一句加進來：翻譯記憶裡有的直接用，沒有的湊滿一個 chunk 就送出翻譯"""
+
+    def __init__(self):
+        self.results = []
+        self.futures = []
+        self._batch = []
+        self._batch_tokens = 0
+
+    def add(self, sentence):
+        for piece in split_chunks([sentence]):
+            translated = _memo_get(piece)
+            self.results.append(translated)
+            if translated is None:
+                self._batch.append((len(self.results) - 1, piece))
+                self._batch_tokens += estimate_tokens(piece)
+                if self._batch_tokens >= translate_chunk_tokens:
+                    self._submit()
+
+    def _submit(self):
+        if self._batch:
+            indices, sentences = zip(*self._batch)
+            self.futures.append((indices, _executor.submit(translate_numbered, list(sentences), indices)))
+            self._batch = []
+            self._batch_tokens = 0
+
+    def finish(self):
+        self._submit()
+        for indices, future in self.futures:
+            for index, translated in zip(indices, future.result()):
+                self.results[index] = translated
+        return "\n".join(result for result in self.results if result)
+
+
 def main(text, language):
     if language == "zh":
         return text
-    result = translate_text_from_vertexAI(text, project_name=YOUR_PROJECT_NAME)
-    return result
+    translator = _SentenceTranslator()
+    for sentence in split_sentences(text):
+        translator.add(sentence)
+    return translator.finish()
+
+
+def translate_segments(segments, language):
+    """邊收轉錄的 segment 邊翻譯，湊滿一個 chunk 就先送出，不用等整段音檔轉完，最後依序接回"""
+    if language == "zh":
+        return "\n".join(segment["text"] for segment in segments)
+
+    translator = _SentenceTranslator()
+    # Whisper 的 segment 常常斷在句子中間，接起來之後只把完整的句子送出，剩下的留到下一個 segment
+    pending = ""
+    for segment in segments:
+        pending += segment["text"]
+        sentences = split_sentences(pending)
+        if sentences and not SENTENCE_END.search(pending) and estimate_tokens(pending) < translate_chunk_tokens:
+            pending = sentences.pop()
+        else:
+            pending = ""
+        for sentence in sentences:
+            translator.add(sentence)
+    for sentence in split_sentences(pending):
+        translator.add(sentence)
+    return translator.finish()
 
 
 if __name__ == "__main__":
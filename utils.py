@@ -1,18 +1,29 @@
+import asyncio
 import json
 import logging
 import os
 import re
 import urllib
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
-import google.generativeai as genai
-import requests
-from PIL import Image
-
-campus_json = json.load(open("campus.json"))
+import cache
+import gemini
+import http_client
+import metrics
+import shortlink
+from campus import replace_location_with_abbrev
+from image_ingest import prepare_image
 
 logger = logging.getLogger(__file__)
 
+# 修改摘要 prompt 時要跟著改版本號，讓舊的快取失效
+summary_model_name = "gemini-1.5-flash"
+summary_prompt_version = "2"
+# 逐字稿超過這麼多 token 就先分段摘要再合併（map-reduce），以下還是一次送出
+summary_map_threshold_tokens = int(os.getenv("SUMMARY_MAP_THRESHOLD_TOKENS", "12000"))
+summary_section_tokens = int(os.getenv("SUMMARY_SECTION_TOKENS", "6000"))
+summary_workers = int(os.getenv("SUMMARY_WORKERS", "4"))
+
 
 def is_url_valid(url):
     regex = re.compile(
@@ -39,23 +50,7 @@ def create_gcal_url(
     return event_url + "&openExternalBrowser=1"
 
 
-def check_image(url=None, b_image=None):
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-    if url is not None:
-        response = requests.get(url)
-        if response.status_code == 200:
-            image_data = response.content
-    elif b_image is not None:
-        image_data = b_image
-    else:
-        return "None"
-    logger.info(f"URL: {url} \n Image: {b_image}")
-    image = Image.open(BytesIO(image_data))
-
-    model = genai.GenerativeModel("gemini-1.5-flash")
-    response = model.generate_content(
-        [
-            """
+image_prompt = """
         請幫我把圖片中的時間、地點、活動標題 以及活動內容提取出來。
         其中時間區間的格式必須符合 Google Calendar 的格式，像是 "20240409T070000Z/20240409T080000Z"。
         由於時區為 GMT+8，所以請記得將時間換算成 GMT+0 的時間。
@@ -69,62 +64,46 @@ def check_image(url=None, b_image=None):
             "title": "大直美術館極限公園",
             "content": "這是一個很棒的地方，歡迎大家來參加！"
         }
-        """,
-            image,
-        ]
-    )
-
-    logger.info(response.text)
-
-    return response.text
+        """
 
 
-def shorten_url_by_reurl_api(short_url):
-    url = "https://api.reurl.cc/shorten"
-
-    headers = {
-        "Content-Type": "application/json",
-        "reurl-api-key": os.getenv("REURL_API_KEY"),
-    }
+def check_image(url=None, b_image=None):
+    if url is not None:
+        response = http_client.get(url, endpoint="image.download")
+        if response.status_code == 200:
+            image_data = response.content
+    elif b_image is not None:
+        image_data = b_image
+    else:
+        return "None"
+    logger.info(f"URL: {url} \n Image: {len(image_data)} bytes")
+    image = prepare_image(image_data)
 
-    response = requests.post(
-        url,
-        headers=headers,
-        data=json.dumps(
-            {
-                "url": short_url,
-            }
-        ),
-    )
-    logger.info(response.json())
-    return response.json()["short_url"]
+    response = gemini.generate_content([image_prompt, image])
 
+    logger.info(response.text)
 
-import re
+    return response.text
 
 
-def replace_location_with_abbrev(input_text):
-    for campus, buildings in campus_json.items():
-        for building_code, building_info in buildings.items():
-            tw_abbrev = building_info.get("tw-abbrev")
-            tw_name = building_info.get("tw")
+async def check_image_async(url):
+    """check_image 的 async 版本：非同步下載、Pillow 處理丟到 thread pool、Gemini 用 async API"""
+    response = await http_client.get_async(url, endpoint="image.download")
+    response.raise_for_status()
+    image = await asyncio.to_thread(prepare_image, response.content)
 
-            if tw_abbrev and tw_abbrev in input_text:
-                input_text = input_text.replace(tw_abbrev, building_code)
+    response = await gemini.generate_content_async([image_prompt, image])
 
-            if tw_name and input_text.startswith(tw_name):
-                input_text = input_text.replace(tw_name, building_code)
+    logger.info(response.text)
 
-            if tw_name and re.search(f"{tw_name}.*", input_text):
-                input_text = re.sub(f"{tw_name}", building_code, input_text)
+    return response.text
 
-            input_text = re.sub(r"[\u4e00-\u9fff]+", lambda match: building_code, input_text)
 
-    return input_text
+def shorten_url_by_reurl_api(short_url):
+    return shortlink.shorten(short_url)
 
 
 def generate_promotion_data(organizer, time, location, event_name, description, fee):
-    model = genai.GenerativeModel("gemini-1.5-flash")
     # model = genai.GenerativeModel("gemini-1.5-pro")
     # imagen = genai.ImageGenerationModel("imagen-3.0-generate-001")
 
@@ -144,56 +123,138 @@ def generate_promotion_data(organizer, time, location, event_name, description,
     生成後輸出文案，請不要用 markdown 語法。
     """
 
-    response = model.generate_content(prompt)
+    response = gemini.generate_content(prompt)
     return response.text
 
 
-def speech_translate_summary(audio_file=None, bimg=None):
-    from whisperx_audio2text import main as audio2text
+def transcribe_and_translate(audio_file):
+    """語音轉文字再翻成繁體中文，逐字稿和翻譯分別依內容 hash 快取。
+    audio_file 可以是音檔的 bytes 或路徑"""
+    import translation
+    import whisperx_audio2text
+
+    if isinstance(audio_file, (bytes, bytearray)):
+        audio_digest = cache.bytes_digest(audio_file)
+    else:
+        audio_digest = cache.file_digest(audio_file)
+    transcript_key = cache.content_key(
+        "transcript",
+        audio_digest,
+        whisperx_audio2text.model_size,
+        whisperx_audio2text.compute_type,
+    )
+    translation_key = cache.content_key(
+        "translation", transcript_key, translation.model_name, translation.prompt_version
+    )
+
+    translated_text = cache.get(translation_key)
+    if translated_text is not None:
+        return translated_text
+
+    transcript = cache.get_json(transcript_key)
+    if transcript is None:
+        with metrics.stage("transcribe_translate"):
+            language, stream = whisperx_audio2text.stream_transcribe(audio_file)
+            segments = []
+
+            def record(stream):
+                for segment in stream:
+                    segments.append(segment)
+                    yield segment
+
+            # 翻譯在轉錄的同時就開始，不必等整段音檔轉完
+            translated_text = translation.translate_segments(record(stream), language)
+        cache.put_json(transcript_key, {"language": language, "segments": segments})
+    else:
+        with metrics.stage("translate"):
+            translated_text = translation.translate_segments(transcript["segments"], transcript["language"])
+
+    cache.put(translation_key, translated_text)
+    return translated_text
 
-    from translation import main as translate
 
+def speech_translate_summary(audio_file=None, bimg=None):
     image = None
     translated_text = None
 
     if audio_file is not None:
-        print("audio2text...")
-        conv_json, text, language = audio2text(audio_file)
+        translated_text = transcribe_and_translate(audio_file)
 
-        print("done. translate...")
-        translated_text = translate(text, language)
+    summary_key = cache.content_key("summary", translated_text, bimg, summary_model_name, summary_prompt_version)
+    summary = cache.get(summary_key)
+    if summary is not None:
+        return summary
 
     if bimg is not None:
-        image = Image.open(BytesIO(bimg))
+        image = prepare_image(bimg)
 
-    model = genai.GenerativeModel("gemini-1.5-flash")
-    if image is None:
-        prompt = f"根據以下課程逐字稿。撰寫一份本課程的重點筆記。\n重點筆記應以markdown格式撰寫，且不可超過20行。\n課程逐字稿：\n{translated_text}"
-        response = model.generate_content([prompt])
-    elif translated_text is None:
-        prompt = f"根據課程的相關圖片。撰寫一份本課程的重點筆記。\n重點筆記應以markdown格式撰寫，且不可超過20行。"
-        response = model.generate_content([prompt, image])
-    else:
-        prompt = f"根據以下課程逐字稿及相關圖片。撰寫一份本課程的重點筆記。\n重點筆記應以markdown格式撰寫，且不可超過20行。\n課程逐字稿：\n{translated_text}"
-        response = model.generate_content([prompt, image])
+    with metrics.stage("summary"):
+        if translated_text is not None and _estimate_tokens(translated_text) > summary_map_threshold_tokens:
+            summary = summarize_sections(translated_text, image)
+        elif image is None:
+            prompt = f"根據以下課程逐字稿。撰寫一份本課程的重點筆記。\n重點筆記應以markdown格式撰寫，且不可超過20行。\n課程逐字稿：\n{translated_text}"
+            summary = gemini.generate_content([prompt], model_name=summary_model_name).text
+        elif translated_text is None:
+            prompt = f"根據課程的相關圖片。撰寫一份本課程的重點筆記。\n重點筆記應以markdown格式撰寫，且不可超過20行。"
+            summary = gemini.generate_content([prompt, image], model_name=summary_model_name).text
+        else:
+            prompt = f"根據以下課程逐字稿及相關圖片。撰寫一份本課程的重點筆記。\n重點筆記應以markdown格式撰寫，且不可超過20行。\n課程逐字稿：\n{translated_text}"
+            summary = gemini.generate_content([prompt, image], model_name=summary_model_name).text
 
-    logger.info(response.text)
+    logger.info(summary)
+    cache.put(summary_key, summary)
 
-    return response.text
+    return summary
+
+
+def _estimate_tokens(text):
+    from translation import estimate_tokens
+
+    return estimate_tokens(text)
+
+
+def summarize_section(index, count, section):
+    """map：整理其中一段逐字稿的重點，依段落內容快取"""
+    section_key = cache.content_key("section-summary", section, summary_model_name, summary_prompt_version)
+    notes = cache.get(section_key)
+    if notes is None:
+        prompt = f"以下是一堂課程逐字稿的第 {index + 1}/{count} 段。請條列這一段的重點，不超過10點，保留重要的名詞、定義、公式和例子。\n逐字稿：\n{section}"
+        notes = gemini.generate_content([prompt], model_name=summary_model_name).text
+        cache.put(section_key, notes)
+    return notes
+
+
+def summarize_sections(translated_text, image=None):
+    """長逐字稿依時間順序切段，各段同時摘要（最多 summary_workers 個），
+    再把各段重點合併成最後的筆記；圖片只在合併時附上"""
+    from translation import split_chunks
+
+    sections = split_chunks(translated_text.splitlines(), max_tokens=summary_section_tokens)
+    logger.info(f"summarizing {len(sections)} sections")
+    with ThreadPoolExecutor(max_workers=max(1, min(summary_workers, len(sections)))) as executor:
+        notes = list(executor.map(summarize_section, range(len(sections)), [len(sections)] * len(sections), sections))
+
+    section_notes = "\n".join(f"## 第 {i + 1} 段\n{note}" for i, note in enumerate(notes))
+    if image is None:
+        prompt = f"根據以下依時間順序排列的各段課程重點。撰寫一份本課程的重點筆記。\n重點筆記應以markdown格式撰寫，且不可超過20行。\n各段重點：\n{section_notes}"
+        return gemini.generate_content([prompt], model_name=summary_model_name).text
+    prompt = f"根據以下依時間順序排列的各段課程重點及相關圖片。撰寫一份本課程的重點筆記。\n重點筆記應以markdown格式撰寫，且不可超過20行。\n各段重點：\n{section_notes}"
+    return gemini.generate_content([prompt, image], model_name=summary_model_name).text
 
 
 def create_form(form, form_service):
     form = form  # { "info": {"title": formName, "documentTitle": formName} }
 
-    result = form_service.forms().create(body=form).execute()
-
-    return result["formId"]
+    # 回傳整個 Form，裡面已經有 formId 和 responderUri
+    with metrics.upstream("forms", "create"):
+        return form_service.forms().create(body=form).execute()
 
 
 def add_form(formId, form, form_service):
     add = form
 
-    form_service.forms().batchUpdate(formId=formId, body=add).execute()
+    with metrics.upstream("forms", "batch_update"):
+        form_service.forms().batchUpdate(formId=formId, body=add).execute()
 
 
 ## 這部分先不會用到
@@ -290,48 +351,33 @@ index由0依序編號。
 """
 
 
-def make_form(audio_path, form_service, access_token):
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-
+def make_form(audio_path, form_service):
     if audio_path is not None:
-        audio_file = genai.upload_file(path=audio_path)
+        # blob 檔名沒有副檔名，SDK 猜不出 MIME type；LINE 的錄音檔是 m4a
+        audio_file = gemini.upload_file(audio_path, mime_type="audio/mp4")
     else:
         return "None"
 
-    model = genai.GenerativeModel("gemini-1.5-flash")
-
-    title_response = model.generate_content([title_prompt, audio_file])
-    title_json = json.loads(title_response.text)
-    formId = create_form(title_json, form_service)
-
-    content_response = model.generate_content([content_prompt, audio_file])
-    content_json = json.loads(content_response.text)
-    add_form(formId, content_json, form_service)
-
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-
-    url = f"https://forms.googleapis.com/v1/forms/{formId}"
-    form_url = requests.get(url, headers=headers).json()["responderUri"]
-
-    return form_url
-
-
-def shorten_url_by_reurl_api(short_url):
-    url = "https://api.reurl.cc/shorten"
-
-    headers = {
-        "Content-Type": "application/json",
-        "reurl-api-key": os.getenv("REURL_API_KEY"),
-    }
-
-    response = requests.post(
-        url,
-        headers=headers,
-        data=json.dumps(
-            {
-                "url": short_url,
-            }
-        ),
-    )
-
-    return response.json()["short_url"]
+    json_config = {"response_mime_type": "application/json"}
+    try:
+        # 標題和題目互不相依，兩個請求同時送出，共用同一個上傳的檔案
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            title_future = executor.submit(
+                gemini.generate_content, [title_prompt, audio_file], generation_config=json_config
+            )
+            content_future = executor.submit(
+                gemini.generate_content, [content_prompt, audio_file], generation_config=json_config
+            )
+
+            title_json = json.loads(title_future.result().text)
+            form = create_form(title_json, form_service)
+
+            content_json = json.loads(content_future.result().text)
+            add_form(form["formId"], content_json, form_service)
+    finally:
+        try:
+            gemini.delete_file(audio_file.name)
+        except Exception as e:
+            logger.warning(f"Failed to delete uploaded file {audio_file.name}: {e}")
+
+    return form["responderUri"]
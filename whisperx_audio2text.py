@@ -1,43 +1,223 @@
+import logging
+import multiprocessing
 import os
-import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
 
+import numpy as np
 from faster_whisper import WhisperModel
+from faster_whisper.audio import decode_audio
 from opencc import OpenCC
-from pydub import AudioSegment
+
+import metrics
 
 device = "cpu"
 batch_size = 16  # reduce if low on GPU mem
 compute_type = "int8"  # change to "int8" if low on GPU mem (may reduce accuracy)
+model_size = os.getenv("WHISPER_MODEL_SIZE", "base")
 hf_api_key = os.getenv("HUGGINGFACE_API_KEY")
 
+sampling_rate = 16000
+# 長錄音切段後用多個 process 平行轉錄
+chunk_seconds = float(os.getenv("WHISPER_CHUNK_SECONDS", "300"))
+chunk_min_seconds = float(os.getenv("WHISPER_CHUNK_MIN_SECONDS", "600"))
+chunk_workers = int(os.getenv("WHISPER_CHUNK_WORKERS", str(os.cpu_count() or 1)))
+
+logger = logging.getLogger(__file__)
+
+# 每個 (size, device, compute_type) 只載入一次，整個 process 共用
+_converter = None
+_models = {}
+_models_lock = threading.Lock()
+_model_locks = {}
+
 
 def load_model(size="tiny", device="cpu", compute_type="int8"):
     model = WhisperModel(size, device, compute_type=compute_type)
     return model
 
 
-def m4a_to_mp3(m4a_file):
-    audio = AudioSegment.from_file(m4a_file, format="m4a")
-    output_file = m4a_file.replace(".m4a", ".mp3")
-    return audio.export(output_file, format="mp3")
+def get_model(size=model_size, device=device, compute_type=compute_type):
+    """取得共用的 WhisperModel，第一次呼叫時才載入"""
+    key = (size, device, compute_type)
+    model = _models.get(key)
+    if model is not None:
+        return model
 
+    with _models_lock:
+        key_lock = _model_locks.setdefault(key, threading.Lock())
 
-def main(audio_file):
-    # with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as temp_audio_file:
-    #     temp_audio_file.write(audio_file)
-    #     audio_file = temp_audio_file.name
+    # 不同 key 可以同時載入，同一個 key 只會載入一次
+    with key_lock:
+        model = _models.get(key)
+        if model is None:
+            logger.info(f"loading whisper model {key}")
+            with metrics.stage("whisper.load"):
+                model = load_model(size, device, compute_type=compute_type)
+            _models[key] = model
+    return model
+
+
+def get_converter():
+    """簡轉繁的 OpenCC converter，整個 process 共用一個"""
+    global _converter
+    if _converter is None:
+        _converter = OpenCC("s2t")
+    return _converter
+
+
+def preload_model():
+    """在 app 啟動時先載入設定的模型"""
+    return get_model(model_size, device, compute_type=compute_type)
+
+
+def find_split_points(audio, target_seconds=chunk_seconds, search_seconds=30, window_seconds=0.1):
+    """在每個目標長度附近找能量最低（最安靜）的位置當切點"""
+    target = int(target_seconds * sampling_rate)
+    search = int(search_seconds * sampling_rate)
+    window = max(1, int(window_seconds * sampling_rate))
+
+    points = [0]
+    while len(audio) - points[-1] > target * 1.5:
+        center = points[-1] + target
+        lo = max(points[-1] + window, center - search)
+        hi = min(len(audio), center + search)
+        n = (hi - lo) // window
+        if n <= 0:
+            break
+        energy = np.square(audio[lo : lo + n * window].reshape(n, window)).mean(axis=1)
+        points.append(lo + int(np.argmin(energy)) * window + window // 2)
+    points.append(len(audio))
+    return points
+
+
+_worker_model = None
+
+
+def _init_chunk_worker(size, cpu_threads):
+    # 每個 worker process 各自持有一個 CPU int8 模型
+    global _worker_model
+    _worker_model = WhisperModel(size, "cpu", compute_type="int8", cpu_threads=cpu_threads)
+
+
+def _transcribe_chunk(index, offset, samples):
+    start_time = time.perf_counter()
+    segments, info = _worker_model.transcribe(samples, beam_size=5)
+    result = [{"text": s.text, "start": s.start + offset, "end": s.end + offset} for s in segments]
+    elapsed = time.perf_counter() - start_time
+    return index, result, info.language, elapsed
+
+
+_chunk_pool = None
+_chunk_pool_lock = threading.Lock()
 
-    model = load_model("base", device, compute_type=compute_type)
-    segments, info = model.transcribe(audio_file, beam_size=5)
-    language = info.language
 
-    result_text = ""
+def get_chunk_pool():
+    global _chunk_pool
+    with _chunk_pool_lock:
+        if _chunk_pool is None:
+            workers = max(1, chunk_workers)
+            cpu_threads = max(1, (os.cpu_count() or 1) // workers)
+            _chunk_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_chunk_worker,
+                initargs=(model_size, cpu_threads),
+            )
+        return _chunk_pool
+
+
+def shutdown_chunk_pool():
+    """app 關閉時呼叫：還沒開始的 chunk 直接取消，worker process 做完手上這段就結束，不等它們"""
+    global _chunk_pool
+    with _chunk_pool_lock:
+        pool, _chunk_pool = _chunk_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def transcribe_chunked(audio):
+    """把 16kHz 的音訊在靜音處切段平行轉錄，依序 yield 每段的 (segments, language)，
+    時間軸已換回整段錄音的時間"""
+    points = find_split_points(audio)
+    pool = get_chunk_pool()
+    futures = [
+        pool.submit(_transcribe_chunk, i, start / sampling_rate, audio[start:end])
+        for i, (start, end) in enumerate(zip(points, points[1:]))
+    ]
+
+    try:
+        for future in futures:
+            index, segments, language, elapsed = future.result()
+            duration = (points[index + 1] - points[index]) / sampling_rate
+            rtf = elapsed / duration if duration else 0.0
+            logger.info(f"chunk {index + 1}/{len(futures)}: {duration:.1f}s audio in {elapsed:.1f}s (RTF {rtf:.2f})")
+            yield segments, language
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def _convert_segments(segments):
+    cc = get_converter()
     for segment in segments:
-        result_text += segment.text + "\n"
+        yield {"text": cc.convert(segment["text"]), "start": segment["start"], "end": segment["end"]}
+
+
+def _decode(audio):
+    if isinstance(audio, (bytes, bytearray)):
+        return decode_audio(BytesIO(audio), sampling_rate=sampling_rate)
+    return decode_audio(audio, sampling_rate=sampling_rate)
+
+
+def load_audio(audio):
+    """把音檔解碼成 16kHz 單聲道 float32 的 numpy array。
+    audio 可以是 bytes（LINE 下載的原始 m4a）、檔案路徑或已經解碼好的 array"""
+    if isinstance(audio, np.ndarray):
+        return audio
+    with metrics.stage("whisper.decode"):
+        return _decode(audio)
 
-    # convert to traditional Chinese
-    cc = OpenCC("s2t")
-    result_text = cc.convert(result_text)
+
+def _timed(segments, audio_seconds, started):
+    # 轉錄是邊跑邊 yield，所以等全部 segment 都產生完才記錄
+    yield from segments
+    elapsed = time.perf_counter() - started
+    metrics.observe_stage("whisper.transcribe", elapsed)
+    metrics.record_transcription(audio_seconds, elapsed)
+
+
+def stream_transcribe(audio_file):
+    """回傳 (language, segments)，segments 是邊轉錄邊產生的 generator，
+    每個 segment 是已轉成繁體的 {"text", "start", "end"}"""
+    audio = load_audio(audio_file)
+    audio_seconds = len(audio) / sampling_rate
+    started = time.perf_counter()
+
+    if chunk_workers > 1 and len(audio) > chunk_min_seconds * sampling_rate:
+        chunks = transcribe_chunked(audio)
+        # 語言以第一段為準，等第一段轉完就能開始往下游送
+        first_segments, language = next(chunks)
+
+        def segments():
+            yield from first_segments
+            for chunk_segments, _ in chunks:
+                yield from chunk_segments
+
+        return language, _convert_segments(_timed(segments(), audio_seconds, started))
+
+    model = get_model(model_size, device, compute_type=compute_type)
+    segments, info = model.transcribe(audio, beam_size=5)
+    segments = ({"text": s.text, "start": s.start, "end": s.end} for s in segments)
+    return info.language, _convert_segments(_timed(segments, audio_seconds, started))
+
+
+def main(audio_file):
+    language, stream = stream_transcribe(audio_file)
+    segments = list(stream)
+    result_text = "".join(segment["text"] + "\n" for segment in segments)
 
     return segments, result_text, language
 